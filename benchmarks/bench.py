@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'src'))
+
+from corpus import corpus_arguments, corpus_options, generate
+from util.ActionCreateFilter import ActionAppendFilePropertyFilter
+from util.ActionCreateFilter import DuplicateFilters
+from util.ActionCreateFilter import FilterChain
+from util.ActionCreateFilter import xxhash
+from util.DirectorySearch import FileEntry
+from util.DirectorySearch import directory_search
+from util.DirectorySearch import file_stat
+from util.DirectorySearch import parallel_directory_search
+from util.Templates import negation
+
+# Times directory search, each builtin filter and DuplicateFilters end to end
+# on a synthetic tree (see corpus.py), writing the results as JSON.
+# Files are read from the page cache after the first repeat, so the best
+# time measures groupby itself rather than the disk
+
+# Filters and options DuplicateFilters is timed with
+group_benchmarks = [
+    ("default", ["size", "progressive_md5"], dict()),
+    ("md5", ["size", "md5"], dict()),
+    ("blake2", ["size", "blake2"], dict()),
+    ("compare", ["size", "compare"], dict()),
+    ("default, 4 threads", ["size", "progressive_md5"], dict(jobs=4)),
+    ("default, pipeline", ["size", "progressive_md5"], dict(pipeline=True)),
+]
+
+
+def timed(func, repeat) -> dict:
+    seconds = list()
+    for null in range(0, repeat):
+        start = time.perf_counter()
+        result = func()
+        seconds.append(time.perf_counter() - start)
+    return dict(seconds=seconds, best=min(seconds), mean=sum(seconds) / len(seconds), result=result)
+
+
+def search_benchmarks(root, repeat, jobs) -> list:
+    results = list()
+    search = timed(lambda: len(list(directory_search(root, dir_hidden=True))), repeat)
+    results.append(dict(name="directory_search", files=search.pop('result'), **search))
+    if jobs > 1:
+        search = timed(lambda: len(list(parallel_directory_search([root], jobs=jobs, dir_hidden=True))), repeat)
+        results.append(dict(name="parallel_directory_search", jobs=jobs, files=search.pop('result'), **search))
+    return results
+
+
+def filter_benchmarks(paths, repeat) -> list:
+    results = list()
+    byte_count = sum(file_stat(path).st_size for path in paths)
+    for name in ActionAppendFilePropertyFilter.filters():
+        if name == "xxh3" and xxhash is None:
+            continue
+        filter_func = ActionAppendFilePropertyFilter._process(name)
+        group_func = ActionAppendFilePropertyFilter.group_filter(filter_func)
+        if group_func is not None:
+            def run():
+                return len(set(group_func(paths)))
+        else:
+            stages = filter_func if isinstance(filter_func, FilterChain) else (filter_func,)
+
+            def run():
+                return len(set(tuple(stage(path) for stage in stages) for path in paths))
+        timing = timed(run, repeat)
+        results.append(dict(name=name, files=len(paths), bytes=byte_count,
+                            outputs=timing.pop('result'), **timing))
+    return results
+
+
+def group_benchmarks_run(root, repeat) -> list:
+    conditions = [FileEntry.is_file,
+                  negation(FileEntry.is_symlink),
+                  lambda filename: file_stat(filename).st_size > 0]
+    results = list()
+    for name, templates, options in group_benchmarks:
+        options = dict(options)
+        jobs = options.pop('jobs', 1)
+
+        def run():
+            executor = ThreadPoolExecutor(max_workers=jobs) if jobs > 1 else None
+            try:
+                filters = [ActionAppendFilePropertyFilter._process(template) for template in templates]
+                groups = DuplicateFilters(filters=filters,
+                                          filenames=directory_search(root, dir_hidden=True),
+                                          conditions=conditions,
+                                          executor=executor,
+                                          **options)
+                return sum(1 for group_list in groups if len(group_list) > 1)
+            finally:
+                if executor is not None:
+                    executor.shutdown()
+        timing = timed(run, repeat)
+        results.append(dict(name=name, filters=templates, jobs=jobs,
+                            duplicate_groups=timing.pop('result'), **timing))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter,
+                                     description="time groupby on a synthetic tree of files")
+    parser.add_argument('--corpus', metavar='DIRECTORY',
+                        help="benchmark an existing tree instead of generating one")
+    parser.add_argument('--repeat', metavar='N', type=int, default=3,
+                        help="times each benchmark is run, default 3")
+    parser.add_argument('--walk-jobs', metavar='N', type=int, default=4,
+                        help="threads for parallel_directory_search, default 4")
+    parser.add_argument('--bench', choices=('search', 'filters', 'groups'), action='append',
+                        help="benchmarks to run, default all")
+    parser.add_argument('-o', '--output', metavar='FILE',
+                        help="write results to FILE rather than standard output")
+    args = corpus_arguments(parser).parse_args()
+    benches = args.bench or ['search', 'filters', 'groups']
+
+    with tempfile.TemporaryDirectory(prefix="groupby-bench-") as temporary_directory:
+        if args.corpus is not None:
+            root = args.corpus
+            corpus = dict(root=root)
+        else:
+            root = temporary_directory
+            corpus = generate(root, **corpus_options(args))
+
+        report = dict(python=platform.python_version(),
+                      platform=platform.platform(),
+                      cpus=os.cpu_count(),
+                      corpus=corpus,
+                      repeat=args.repeat,
+                      )
+        if 'search' in benches:
+            report['search'] = search_benchmarks(root, args.repeat, args.walk_jobs)
+        if 'filters' in benches:
+            paths = [path for path in directory_search(root, dir_hidden=True) if path.is_file()]
+            report['filters'] = filter_benchmarks(paths, args.repeat)
+        if 'groups' in benches:
+            report['groups'] = group_benchmarks_run(root, args.repeat)
+
+    output = json.dumps(report, indent=2)
+    if args.output is not None:
+        with open(args.output, 'w') as file:
+            file.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
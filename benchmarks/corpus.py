@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import os
+import random
+
+# Reproducible trees of files to benchmark groupby on. The same seed and
+# options always produce the same tree.
+# A share of the files are duplicates of earlier files, and a share are near
+# duplicates: the same size as an earlier file, differing only in the last byte,
+# so only a full read tells them apart
+
+
+def random_bytes(rng, size) -> bytes:
+    if size == 0:
+        return b''
+    return rng.getrandbits(size * 8).to_bytes(size, 'little')
+
+
+def file_size(rng, *, distribution, min_size, max_size) -> int:
+    if distribution == 'lognormal':
+        # Mostly small files with a long tail of large ones, like most real trees
+        middle = (min_size * max_size) ** 0.5 if min_size > 0 else max_size / 64
+        size = int(rng.lognormvariate(0, 1.5) * middle)
+    else:
+        size = rng.randint(min_size, max_size)
+    return max(min_size, min(size, max_size))
+
+
+def directories(rng, root, *, fanout, depth, hidden_ratio) -> list:
+    found = [root]
+    level = [root]
+    for null in range(0, depth):
+        next_level = list()
+        for parent in level:
+            for number in range(0, fanout):
+                name = "d{}".format(number)
+                if rng.random() < hidden_ratio:
+                    name = '.' + name
+                next_level.append(os.path.join(parent, name))
+        found.extend(next_level)
+        level = next_level
+    return found
+
+
+def generate(root, *, files=1000, fanout=4, depth=3, distribution='lognormal',
+             min_size=0, max_size=1048576, duplicate_ratio=0.3, near_duplicate_ratio=0.1,
+             hidden_ratio=0.1, seed=0) -> dict:
+    rng = random.Random(seed)
+    tree = directories(rng, root, fanout=fanout, depth=depth, hidden_ratio=hidden_ratio)
+    for directory in tree:
+        os.makedirs(directory, exist_ok=True)
+
+    written = list()
+    counts = dict(unique=0, duplicate=0, near_duplicate=0)
+    for number in range(0, files):
+        filename = os.path.join(rng.choice(tree), "f{}.bin".format(number))
+        kind = rng.random()
+        if written and kind < duplicate_ratio:
+            with open(rng.choice(written), 'rb') as source:
+                content = source.read()
+            counts['duplicate'] += 1
+        elif written and kind < duplicate_ratio + near_duplicate_ratio:
+            with open(rng.choice(written), 'rb') as source:
+                content = source.read()
+            if content:
+                content = content[:-1] + bytes([(content[-1] + 1) % 256])
+            counts['near_duplicate'] += 1
+        else:
+            size = file_size(rng, distribution=distribution, min_size=min_size, max_size=max_size)
+            content = random_bytes(rng, size)
+            counts['unique'] += 1
+        with open(filename, 'wb') as file:
+            file.write(content)
+        written.append(filename)
+
+    return dict(root=root, files=files, directories=len(tree), fanout=fanout, depth=depth,
+                distribution=distribution, min_size=min_size, max_size=max_size,
+                duplicate_ratio=duplicate_ratio, near_duplicate_ratio=near_duplicate_ratio,
+                hidden_ratio=hidden_ratio, seed=seed, **counts)
+
+
+def corpus_arguments(parser):
+    parser.add_argument('--files', metavar='N', type=int, default=1000,
+                        help="number of files, default 1000")
+    parser.add_argument('--fanout', metavar='N', type=int, default=4,
+                        help="subdirectories per directory, default 4")
+    parser.add_argument('--depth', metavar='N', type=int, default=3,
+                        help="levels of subdirectories, default 3")
+    parser.add_argument('--distribution', choices=('lognormal', 'uniform'), default='lognormal',
+                        help="distribution of file sizes, default lognormal")
+    parser.add_argument('--min-size', metavar='BYTES', type=int, default=0)
+    parser.add_argument('--max-size', metavar='BYTES', type=int, default=1048576)
+    parser.add_argument('--duplicate-ratio', metavar='RATIO', type=float, default=0.3,
+                        help="share of files copying an earlier file, default 0.3")
+    parser.add_argument('--near-duplicate-ratio', metavar='RATIO', type=float, default=0.1,
+                        help="share of files differing from an earlier file\n"
+                             "only in the last byte, default 0.1")
+    parser.add_argument('--hidden-ratio', metavar='RATIO', type=float, default=0.1,
+                        help="share of hidden directories, default 0.1")
+    parser.add_argument('--seed', type=int, default=0)
+    return parser
+
+
+def corpus_options(args) -> dict:
+    return dict(files=args.files, fanout=args.fanout, depth=args.depth,
+                distribution=args.distribution, min_size=args.min_size, max_size=args.max_size,
+                duplicate_ratio=args.duplicate_ratio, near_duplicate_ratio=args.near_duplicate_ratio,
+                hidden_ratio=args.hidden_ratio, seed=args.seed)
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter,
+                                     description="generate a synthetic tree of files")
+    parser.add_argument('directory', help="where the tree is created")
+    args = corpus_arguments(parser).parse_args()
+    print(json.dumps(generate(args.directory, **corpus_options(args)), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -2,15 +2,26 @@
 
 import argparse
 import logging
-import os
 import sys
-from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
 
 from util.ActionCreateFilter import DuplicateFilters, ActionAppendFilePropertyFilter
+from util.ActionCreateFilter import FilterLabels, LateGroup
+from util.ActionCreateFunc import ActionAppendExecShell
+from util.ActionCreateFunc import keeps_first
 from util.ActionCreateFunc import print_results
 from util.ArgumentParsing import parser_logic
+from util.DirectorySearch import FileEntry
 from util.DirectorySearch import directory_search
+from util.DirectorySearch import file_stat
+from util.DirectorySearch import parallel_directory_search
+from util.FileRead import FileReader
+from util.FilterCache import FilterCache
 from util.Logging import log_levels
+from util.Logging import stats
+from util.Pipeline import lookahead
+from util.Templates import AsyncShellPool
 from util.Templates import negation
 from util.Templates import sanitize_object
 
@@ -31,29 +42,50 @@ def main():
                             format='[%(levelname)s] %(message)s',
                             )
 
+    if args.stats is not None or args.progress is True:
+        stats.enable()
+    if args.progress is True:
+        stats.start_progress()
+
     # Usage of set to remove directories specified multiple times
-    paths = (path for directory in set(args.directories)
-             for path in directory_search(directory,
-                                          recursive=args.recursive,
-                                          dir_hidden=args.dir_hidden,
-                                          max_depth=args.max_depth,
-                                          include=args.include,
-                                          exclude=args.exclude,
-                                          dir_include=args.dir_include,
-                                          dir_exclude=args.dir_exclude,
-                                          )
-             )
+    search_options = dict(recursive=args.recursive,
+                          dir_hidden=args.dir_hidden,
+                          max_depth=args.max_depth,
+                          include=args.include,
+                          exclude=args.exclude,
+                          dir_include=args.dir_include,
+                          dir_exclude=args.dir_exclude,
+                          )
+    if args.walk_jobs > 1:
+        paths = parallel_directory_search(set(args.directories), jobs=args.walk_jobs, **search_options)
+    else:
+        paths = (path for directory in set(args.directories)
+                 for path in directory_search(directory, **search_options))
 
     # Default filtering method
     if not args.filters:
-        size = ActionAppendFilePropertyFilter.disk_size
-        md5  = ActionAppendFilePropertyFilter.md5_sum
-        args.filters = [size, md5]
+        size = ActionAppendFilePropertyFilter._process("size")
+        progressive_md5 = ActionAppendFilePropertyFilter._process("progressive_md5")
+        args.filters = [size, progressive_md5]
+
+    # Fast digests can collide, groups surviving them are confirmed with sha256
+    if args.verify is True:
+        args.filters.append(ActionAppendFilePropertyFilter._process("sha"))
+
+    ActionAppendFilePropertyFilter.read_engine = FileReader(args.read_mode,
+                                                            chunk_size=max(args.read_size, 1),
+                                                            drop_cache=args.drop_cache)
+
+    filter_cache = None
+    if args.cache is not None:
+        filter_cache = FilterCache(args.cache)
+        args.filters = [filter_cache.wrap(filter_) for filter_ in args.filters]
 
+    # Paths are FileEntry objects, all conditions share one stat per file
     conditions = {
-        "is_file": os.path.isfile,
-        "not_symbolic_link": negation(os.path.islink),
-        "not_empty": lambda filename: os.path.getsize(filename) > 0,
+        "is_file": FileEntry.is_file,
+        "not_symbolic_link": negation(FileEntry.is_symlink),
+        "not_empty": lambda filename: file_stat(filename).st_size > 0,
     }
     # Directory condition modifying
     if args.follow_symbolic is True:
@@ -61,42 +93,103 @@ def main():
     if args.empty_file is True:
         conditions.pop("not_empty")
 
-    filtered_groups = DuplicateFilters(filters=args.filters, filenames=paths, conditions=conditions.values())
+    # hashlib releases the GIL while hashing, so checksum filters scale with threads
+    if args.jobs > 1:
+        executor = ThreadPoolExecutor(max_workers=args.jobs)
+    else:
+        executor = None
+    # Filters evaluated in Python hold the GIL, so they need processes instead
+    if args.cpu_jobs > 1:
+        cpu_executor = ProcessPoolExecutor(max_workers=args.cpu_jobs)
+    else:
+        cpu_executor = None
+
+    # Shell commands run on an AsyncShellPool when run concurrently or limited
+    shell_limits = dict(timeout=args.shell_timeout,
+                        memory_limit=args.shell_memory,
+                        cpu_limit=args.shell_cpu,
+                        )
+    shell_limited = any(limit is not None for limit in shell_limits.values())
+    if args.filter_jobs > 1 or shell_limited:
+        shell_pool = AsyncShellPool(args.filter_jobs, **shell_limits)
+    else:
+        shell_pool = None
+
+    filtered_groups = DuplicateFilters(filters=args.filters,
+                                       filenames=paths,
+                                       conditions=conditions.values(),
+                                       group_size=args.group_size,
+                                       executor=executor,
+                                       cpu_executor=cpu_executor,
+                                       pipeline=args.pipeline,
+                                       incremental=args.incremental,
+                                       spill_dir=args.spill_dir,
+                                       spill_records=args.spill_records,
+                                       filter_batch=args.filter_batch,
+                                       shell_pool=shell_pool,
+                                       reorder=not args.no_reorder,
+                                       )
 
     # With no action defined, just print the results
     if args.group_action:
         group_action = args.group_action[-1]
     else:
         group_action = print_results
-    for results in filtered_groups:
-        output_string_occurred = False
-        if len(results) >= args.group_size:
-            # Take each filters output and label f1: 1st_output, fn: n_output...
-            # Strip filter_output because of embedded newline
-            labeled_filters = OrderedDict()
-            source_result = results[0]
-            for filter_number, filter_output in enumerate(filtered_groups.filter_hashes[source_result]):
-                labeled_filters["f{fn}".format(fn=filter_number + 1)] = filter_output.strip()
-
-            command_string = group_action(results, labeled_filters=labeled_filters)
-            if command_string is not None:
-                for output in command_string:
-                    if output:
-                        output_string_occurred = True
-
-                        # Sanitize and handle all newline characters from
-                        # messing up output
-                        output = sanitize_object(output)
-                        output = ' '.join(output.splitlines())
-                        print(output)
-                if output_string_occurred is True:
-                    print('')
+    # Only -x commands are limited, the other actions don't start a shell
+    if args.exec_jobs > 1 or (shell_limited and ActionAppendExecShell.runs_shell(group_action)):
+        exec_pool = AsyncShellPool(args.exec_jobs, **shell_limits)
+        group_action = ActionAppendExecShell.concurrent(group_action, exec_pool)
+
+    def group_outputs():
+        for results in filtered_groups:
+            if isinstance(results, LateGroup):
+                # The rest of the group was already acted on, only the late files are
+                labeled_filters = FilterLabels(filtered_groups, results.kept)
+                if keeps_first(group_action):
+                    results = [results.kept] + list(results)
+                yield group_action(results, labeled_filters=labeled_filters)
+            elif len(results) >= args.group_size:
+                # Take each filters output and label f1: 1st_output, fn: n_output...
+                labeled_filters = FilterLabels(filtered_groups, results[0])
+                yield group_action(results, labeled_filters=labeled_filters)
             else:
+                # Removes extra blank newlines
                 continue
+
+    # Concurrent commands are started for the next groups while
+    # the current group's output is printed
+    command_strings = group_outputs()
+    if args.exec_jobs > 1:
+        command_strings = lookahead(command_strings, args.exec_jobs * 2)
+
+    for command_string in command_strings:
+        output_string_occurred = False
+        if command_string is not None:
+            for output in command_string:
+                if output:
+                    output_string_occurred = True
+
+                    # Sanitize and handle all newline characters from
+                    # messing up output
+                    output = sanitize_object(output)
+                    output = ' '.join(output.splitlines())
+                    print(output)
+            if output_string_occurred is True:
+                print('')
         else:
-            # Removes extra blank newlines
             continue
 
+    for pool in (executor, cpu_executor):
+        if pool is not None:
+            pool.shutdown()
+
+    stats.stop_progress()
+    if args.stats is not None:
+        extra = dict()
+        if filter_cache is not None:
+            extra['cache'] = dict(hits=filter_cache.hits, misses=filter_cache.misses)
+        stats.write(args.stats, **extra)
+
 
 if __name__ == '__main__':
     try:
@@ -4,13 +4,33 @@ import logging
 import math
 import os
 import re
+from array import array
 from collections import OrderedDict
+from collections.abc import Mapping
 from collections import defaultdict
+from collections import deque
 from functools import partial
+from itertools import count
+from itertools import islice
+from operator import methodcaller
 
+from util.BatchKeys import date_keys, date_label, size_keys, size_label
+from util.DirectorySearch import FileEntry, file_stat
+from util.ExternalGroup import external_group
+from util.FileRead import FileReader
+from util.Logging import stats
+from util.PathTable import FilterHashes, PathTable, StatTable, compact_output
+from util.Pipeline import background, lookahead
 from util.Templates import ActionAppendCreateFunc, \
     EscapedBraceExpansion
-from util.Templates import invoke_shell, sanitize_object
+from util.Templates import invoke_shell, invoke_shell_batch, render_shell, sanitize_object
+from util.Templates import ShellCoprocess
+
+# xxhash is optional, only needed by the xxh3 filter
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
 
 # This matches a newline, a space, tab, return character OR a null value: between the | and )
 _whitespace = re.compile('^([\n \t\r]|)+$')
@@ -18,10 +38,33 @@ _whitespace = re.compile('^([\n \t\r]|)+$')
 log = logging.getLogger(__name__)
 
 
+# Filter outputs are strings or bytes, or integer keys from batched builtin filters
+def _strip(output):
+    if isinstance(output, int):
+        return output
+    return output.strip()
+
+
+def _blank(output) -> bool:
+    if isinstance(output, int):
+        return False
+    # Only checks for values less then 10 (for performance)
+    if len(output) < 10:
+        if len(output) == 0:
+            return True
+        elif _whitespace.match(str(output)):
+            return True
+    return False
+
+
 class ActionSelectFilter(ActionAppendCreateFunc):
+    filters = None
+    aliases = None
+
     def _process(self, template):
-        self.filters = ActionAppendFilePropertyFilter.filters()
-        self.aliases = EscapedBraceExpansion.aliases()
+        if self.filters is None:
+            self.filters = ActionAppendFilePropertyFilter.filters()
+            self.aliases = EscapedBraceExpansion.aliases()
         selected_filter = self.check_filter_type(template)
         return selected_filter
 
@@ -32,6 +75,8 @@ class ActionSelectFilter(ActionAppendCreateFunc):
             filter_check = template
         if filter_check in self.filters:
             return ActionAppendFilePropertyFilter._process(template)
+        elif filter_check == "coproc" and "::" in template:
+            return ActionAppendShellFilter._coprocess(template)
         elif any((alias in template
                   for alias in self.aliases.keys())):
             return ActionAppendShellFilter._process(template)
@@ -47,200 +92,505 @@ class OrderedDefaultListDict(OrderedDict):
         return value
 
 
+# Files found in incremental mode after their group was reported. It is reported
+# whatever its size, since the rest of the group already was. kept is the first
+# file of that group, already acted on
+class LateGroup(list):
+    def __init__(self, members, kept):
+        super().__init__(members)
+        self.kept = kept
+
+
+# The labels f1 to fn of a group, the outputs of its first file. Each is only
+# found once looked up, as a group of one may not have run every filter
+class FilterLabels(Mapping):
+    def __init__(self, duplicate_filters, path):
+        self._duplicate_filters = duplicate_filters
+        self._path = path
+        self._filter_numbers = OrderedDict(("f{fn}".format(fn=filter_number + 1), filter_number)
+                                           for filter_number in range(len(duplicate_filters.filters)))
+        self._labels = dict()
+
+    def __getitem__(self, key):
+        if key not in self._labels:
+            filter_number = self._filter_numbers.get(key)
+            label = None
+            if filter_number is not None:
+                label = self._duplicate_filters.label(self._path, filter_number)
+            if label is None:
+                raise KeyError(key)
+            # Strip the label because of embedded newline
+            self._labels[key] = label.strip()
+        return self._labels[key]
+
+    def __iter__(self):
+        return (key for key in self._filter_numbers if key in self)
+
+    # The labels found without running a filter, e.g. for logging
+    def known(self):
+        known_labels = list()
+        for filter_number in self._filter_numbers.values():
+            label = self._duplicate_filters.label(self._path, filter_number, find=False)
+            if label is not None:
+                known_labels.append(label.strip())
+        return known_labels
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+
+# A group being built by DuplicateFilters in incremental mode. Below the last
+# filter a node holds the groups split by the next filter in children. A single
+# path is kept in pending, since it can't form a group until another path joins it
+class _IncrementalNode:
+    __slots__ = ('children', 'pending', 'members', 'late_members')
+
+    def __init__(self):
+        self.children = OrderedDict()
+        self.pending = None
+        self.members = list()
+        self.late_members = list()
+
+
+# A sequence of filters applied as successive stages, but reported as one filter.
+# Only the groups surviving a stage are handed to the next one
+class FilterChain(tuple):
+    def label(self, outputs):
+        joined_outputs = '\0'.join(str(output) for output in outputs)
+        return hashlib.md5(joined_outputs.encode()).hexdigest()
+
+
 class ActionAppendShellFilter(ActionAppendCreateFunc):
     @staticmethod
     def _process(template):
         template_format = EscapedBraceExpansion(template)
         shell_command = partial(invoke_shell, command=template_format)
+        shell_command.spec = template
+        # Used by DuplicateFilters to pass several filenames to one command
+        shell_command.batch = partial(invoke_shell_batch, command=template_format)
+        # Used by DuplicateFilters to run the command on a shell pool
+        shell_command.render = partial(render_shell, command=template_format)
+        return shell_command
+
+    # coproc::COMMAND starts COMMAND once, writing each filename to it
+    @staticmethod
+    def _coprocess(template):
+        command = template.split("::", 1)[1]
+        shell_command = partial(ShellCoprocess(command))
+        shell_command.spec = template
         return shell_command
 
 
 class ActionAppendFilePropertyFilter(ActionAppendCreateFunc):
+    # Shared by every content filter, set up from the command line in main
+    read_engine = FileReader()
+    _compare_subgroups = count(1)
+
+    # Built once, filters are looked up for every template
+    _filters = None
+
     @classmethod
     def filters(cls):
+        if cls._filters is not None:
+            return cls._filters
         filters = OrderedDict(
             {
-                "partial_md5": cls.partial_md5_sum,
-                "md5"        : cls.md5_sum,
-                "sha"        : cls.sha_sum,
-                "modified"   : cls.modification_date,
-                "accessed"   : cls.access_date,
-                "size"       : cls.disk_size,
-                "filename"   : cls.file_name,
+                "progressive_md5": cls.progressive_md5_sum(),
+                "partial_md5"    : cls.partial_md5_sum,
+                "md5"            : cls.md5_sum,
+                "sha"            : cls.sha_sum,
+                "blake2"         : cls.blake2_sum,
+                "xxh3"           : cls.xxh3_sum,
+                "compare"        : cls.compare_filter(),
+                "modified"       : cls.modification_date,
+                "accessed"       : cls.access_date,
+                "size"           : cls.disk_size,
+                "filename"       : cls.file_name,
             }
         )
+        cls._filters = filters
         return filters
 
+    # Builtin filters which read the contents of a file, rather than its metadata
+    @staticmethod
+    def content_filters():
+        return {"progressive_md5", "partial_md5", "md5", "sha", "blake2", "xxh3"}
+
+    # Builtin filters spending their time in Python code, holding the GIL
+    @staticmethod
+    def cpu_filters():
+        return {"modified", "accessed", "filename"}
+
+    # Rough cost of running a filter on one file, and the share of files it leaves
+    # grouped together, used to run cheap and discriminating filters first
+    @staticmethod
+    def filter_costs():
+        return {
+            "filename"       : (1, 0.5),
+            "size"           : (2, 0.1),
+            "modified"       : (2, 0.3),
+            "accessed"       : (2, 0.5),
+            "progressive_md5": (5, 0.01),
+            "partial_md5"    : (10, 0.02),
+            "compare"        : (20, 0.01),
+            "xxh3"           : (30, 0.01),
+            "blake2"         : (40, 0.01),
+            "md5"            : (50, 0.01),
+            "sha"            : (60, 0.01),
+            "coproc"         : (50, 0.5),
+            "shell"          : (100, 0.5),
+        }
+
+    @classmethod
+    def filter_cost(cls, filter_func) -> tuple:
+        if isinstance(filter_func, FilterChain):
+            filter_func = filter_func[-1]
+        spec = getattr(filter_func, "spec", "")
+        name = spec.split("::", 1)[0]
+        if name not in cls.filter_costs():
+            name = "shell"
+        cost, selectivity = cls.filter_costs()[name]
+        # Rounding puts more files together
+        if "::" in spec and name in ("size", "modified", "accessed"):
+            selectivity = 0.6
+        return cost, selectivity
+
+    @classmethod
+    def reads_content(cls, filter_func):
+        spec = getattr(filter_func, "spec", "")
+        return spec.split("::", 1)[0] in cls.content_filters()
+
+    @classmethod
+    def cpu_bound(cls, filter_func):
+        spec = getattr(filter_func, "spec", "")
+        return spec.split("::", 1)[0] in cls.cpu_filters()
+
+    # The template a filter was created from is kept as its spec, identifying
+    # what the filter computes (e.g. for caching its output)
+    @staticmethod
+    def _with_spec(filter_func, spec):
+        if not isinstance(filter_func, partial):
+            filter_func = partial(filter_func)
+        filter_func.spec = spec
+        return filter_func
+
     @classmethod
     def _process(cls, template):
         if "::" in template:
             func_name, abstraction = template.split("::", 1)
-            func_name = cls.filters()[func_name]
-            filter_func = partial(func_name, abstraction=abstraction)
+            cls._check_digest(func_name, abstraction)
+            filter_func = partial(cls.filters()[func_name], **cls._compile(func_name, abstraction))
         else:
-            func_name = template
+            func_name, abstraction = template, None
+            cls._check_digest(func_name)
             filter_func = cls.filters()[func_name]
 
+        if isinstance(filter_func, FilterChain):
+            return filter_func
+        return cls._with_batch(cls._with_spec(filter_func, template), func_name, abstraction)
+
+    # size, modified and accessed are also given whole batches of files, returning
+    # integer keys rather than strings. label turns a key back into the usual output
+    @classmethod
+    def _with_batch(cls, filter_func, func_name, abstraction=None):
+        if func_name == "size":
+            divisor, unit = (None, None) if abstraction is None else cls._size_unit(abstraction)
+            filter_func.batch = partial(cls._size_keys, divisor=divisor)
+            filter_func.label = partial(size_label, unit=unit)
+        elif func_name in ("modified", "accessed") and abstraction is not None and '%' not in abstraction:
+            field = cls.aliases("datetime_round")[abstraction.upper()]
+            attribute = "st_mtime" if func_name == "modified" else "st_atime"
+            filter_func.batch = partial(cls._date_keys, attribute=attribute, field=field)
+            filter_func.label = partial(date_label, field=field)
         return filter_func
 
+    @staticmethod
+    def _size_keys(filenames, *, divisor) -> list:
+        return size_keys([file_stat(filename).st_size for filename in filenames], divisor)
+
+    @staticmethod
+    def _date_keys(filenames, *, attribute, field) -> list:
+        return date_keys([getattr(file_stat(filename), attribute) for filename in filenames], field)
+
+    # Fast digests are checked once, rather than failing on every file
+    @staticmethod
+    def _check_digest(func_name, abstraction=None):
+        if func_name == "xxh3" and xxhash is None:
+            log.error("xxh3 requires the xxhash module, pip install xxhash")
+            exit(1)
+        valid_sizes = {
+            "blake2": (range(1, 65), "1 - 64"),
+            "xxh3"  : ((64, 128), "64, 128"),
+        }
+        if abstraction is not None and func_name in valid_sizes:
+            sizes, sizes_help = valid_sizes[func_name]
+            if not abstraction.isdigit() or int(abstraction) not in sizes:
+                log.error("Modifier {} is not valid".format(abstraction))
+                print("Valid Sizes:", sizes_help, sep='\n  ')
+                exit(1)
+
+    # Modifiers are resolved once, into what the filter uses on every file
+    @classmethod
+    def _compile(cls, func_name, abstraction) -> dict:
+        if func_name == "size":
+            return dict(rounding=cls._size_rounding(abstraction))
+        elif func_name in ("modified", "accessed"):
+            return dict(rounding=cls._datetime_rounding(abstraction))
+        elif func_name == "filename":
+            return dict(rounding=cls._filename_rounding(abstraction))
+        elif func_name in cls.digests():
+            return dict(constructor=cls._digest_constructor(func_name, abstraction))
+        # The remaining filters take no modifier
+        log.error("Modifier {} is not valid".format(abstraction))
+        exit(1)
+
     # https://stackoverflow.com/a/14822210
     @classmethod
-    def _size_round(cls, size_bytes, abstraction=None):
+    def _size_rounding(cls, abstraction):
+        divisor, unit = cls._size_unit(abstraction)
+        return partial(cls._size_round, divisor=divisor, unit=unit)
+
+    @classmethod
+    def _size_unit(cls, abstraction) -> tuple:
         aliases = cls.aliases("size_round")
-        abstraction = abstraction.upper()
         size_pow = OrderedDict([("B", 0), ("KB", 1), ("MB", 2), ("GB", 3), ("TB", 4), ("PB", 5)])
-        if size_bytes == 0:
-            return "0{}".format(aliases[abstraction])
         try:
-            power_level = size_pow[aliases[abstraction]]
+            unit = aliases[abstraction.upper()]
         except KeyError as e:
             log.error("Modifier {} is not valid".format(e))
-            # Set used to remove duplicate values
             print("Valid Keys:", *size_pow.keys(), sep='\n  ')
             exit(1)
+        return math.pow(1024, size_pow[unit]), unit
 
-        p = math.pow(1024, power_level)
-        s = round(size_bytes / p, 0)
-
+    @staticmethod
+    def _size_round(size_bytes, *, divisor, unit) -> str:
         # Convert to integer
-        real_number = int(s)
-        output = "{}{}".format(real_number, aliases[abstraction])
-        return output
+        real_number = int(round(size_bytes / divisor, 0))
+        return "{}{}".format(real_number, unit)
 
     @classmethod
-    def _filename_round(cls, filename, abstraction=None):
-        def re_match(filename, *, pattern) -> str:
-            assert isinstance(pattern, re._pattern_type)
-            split_filename = os.path.split(filename)[1]
-
-            # If capture groups are used, use them,
-            # otherwise return the entire matched expression
-            result = pattern.search(split_filename)
-            if result and result.groups():
-                value = ''.join(value for value in result.groups() if value)
-            elif result and result.group():
-                value = result.group()
-            else:
-                value = ' '
-            return value
-
+    def _filename_rounding(cls, abstraction):
         try:
-            expr = re.compile(abstraction)
-        except Exception as e:
+            pattern = re.compile(abstraction)
+        except re.error as e:
             err_msg = 'Regex "{expr}" generated this error\n{err}'
-            log.error(err_msg.format(expr=expr, err=e))
+            log.error(err_msg.format(expr=abstraction, err=e))
             exit(1)
-        regex_pattern = re_match(filename, pattern=expr)
-        return regex_pattern
+        return partial(cls._filename_round, pattern=pattern)
+
+    @staticmethod
+    def _filename_round(filename, *, pattern) -> str:
+        split_filename = os.path.split(filename)[1]
+
+        # If capture groups are used, use them,
+        # otherwise return the entire matched expression
+        result = pattern.search(split_filename)
+        if result and result.groups():
+            value = ''.join(value for value in result.groups() if value)
+        elif result and result.group():
+            value = result.group()
+        else:
+            value = ' '
+        return value
+
+    # Splits a file of size into the byte ranges read by each progressive tier:
+    # the head and tail blocks, evenly spaced sample blocks and everything else.
+    # No byte belongs to more than one tier
+    @staticmethod
+    def _progressive_ranges(size, block_size=65536, samples=16) -> tuple:
+        head = (0, min(size, block_size))
+        tail = (max(head[1], size - block_size), size)
+        head_tail = [byte_range for byte_range in (head, tail) if byte_range[0] < byte_range[1]]
+
+        middle_start, middle_stop = head[1], tail[0]
+        sampled, remainder = list(), list()
+        if middle_stop - middle_start <= block_size * samples:
+            if middle_start < middle_stop:
+                sampled.append((middle_start, middle_stop))
+        else:
+            stride = (middle_stop - middle_start) // samples
+            position = middle_start
+            for sample in range(0, samples):
+                sample_start = middle_start + sample * stride
+                if position < sample_start:
+                    remainder.append((position, sample_start))
+                sampled.append((sample_start, sample_start + block_size))
+                position = sample_start + block_size
+            remainder.append((position, middle_stop))
+        return head_tail, sampled, remainder
 
-    # Used with checksum functions to reduce memory footprint
     @classmethod
-    def _iter_read(cls, filename: str, chunk_size=65536) -> bytes:
-        try:
-            with open(filename, 'rb') as file:
-                for chunk in iter(lambda: file.read(chunk_size), b''):
-                    yield chunk
-        except PermissionError:
-            log.warning("Permission Denied for {}".format(filename))
+    def _progressive_tier_sum(cls, filename, *, tier) -> str:
+        checksumer = hashlib.md5()
+        byte_ranges = cls._progressive_ranges(file_stat(filename).st_size)[tier]
+        if byte_ranges and not cls.read_engine.update(checksumer, filename, byte_ranges):
+            return ''
+        return checksumer.hexdigest()
 
+    # Size, then the head and tail of the file, then sampled blocks and finally
+    # the rest of the file. Each tier only runs on groups surviving the last one
     @classmethod
-    def access_date(cls, filename: str, *, abstraction=None) -> str:
-        access_time = os.path.getmtime(filename)
+    def progressive_md5_sum(cls):
+        tiers = FilterChain((
+            cls._with_batch(cls._with_spec(cls.disk_size, "size"), "size"),
+            cls._with_spec(partial(cls._progressive_tier_sum, tier=0), "progressive_md5::0"),
+            cls._with_spec(partial(cls._progressive_tier_sum, tier=1), "progressive_md5::1"),
+            cls._with_spec(partial(cls._progressive_tier_sum, tier=2), "progressive_md5::2"),
+        ))
+        return tiers
+
+    @classmethod
+    def access_date(cls, filename: str, *, rounding=None) -> str:
+        access_time = file_stat(filename).st_atime
         access_datetime = datetime.datetime.fromtimestamp(access_time)
-        if abstraction is not None:
-            access_datetime = cls._datetime_round(access_datetime, abstraction)
+        if rounding is not None:
+            access_datetime = rounding(access_datetime)
         spaces_converted = str(access_datetime).replace(' ', '_')
         return str(spaces_converted)
 
     @classmethod
-    def modification_date(cls, filename: str, *, abstraction=None) -> str:
-        modification_time = os.path.getmtime(filename)
+    def modification_date(cls, filename: str, *, rounding=None) -> str:
+        modification_time = file_stat(filename).st_mtime
         modified_datetime = datetime.datetime.fromtimestamp(modification_time)
-        if abstraction is not None:
-            modified_datetime = cls._datetime_round(modified_datetime, abstraction)
+        if rounding is not None:
+            modified_datetime = rounding(modified_datetime)
         spaces_converted = str(modified_datetime).replace(' ', '_')
         return str(spaces_converted)
 
     @classmethod
-    def file_name(cls, filename: str, *, abstraction=None) -> str:
-        file_basename = os.path.basename(filename)
-        if abstraction is not None:
-            file_basename = cls._filename_round(filename, abstraction=abstraction)
-        return str(file_basename)
+    def file_name(cls, filename: str, *, rounding=None) -> str:
+        if rounding is not None:
+            return rounding(filename)
+        return os.path.basename(filename)
 
     @classmethod
-    def disk_size(cls, filename: str, *, abstraction=None) -> str:
-        byte_usage = os.path.getsize(filename)
-        if abstraction is not None:
-            byte_usage = cls._size_round(byte_usage, abstraction=abstraction)
+    def disk_size(cls, filename: str, *, rounding=None) -> str:
+        byte_usage = file_stat(filename).st_size
+        if rounding is not None:
+            return rounding(byte_usage)
         return str(byte_usage)
 
     @classmethod
-    def md5_sum(cls, filename, *, chunk_size=65536) -> str:
+    def md5_sum(cls, filename) -> str:
         checksumer = hashlib.md5()
-        for chunk in cls._iter_read(filename, chunk_size):
-            checksumer.update(chunk)
+        if not cls.read_engine.update(checksumer, filename):
+            return ''
         file_hash = checksumer.hexdigest()
         return str(file_hash)
 
     @classmethod
-    def sha_sum(cls, filename, *, chunk_size=65536, abstraction=None) -> str:
-        sha_levels = {
-            '1': hashlib.sha1,
-            '224': hashlib.sha224,
-            '256': hashlib.sha256,
-            '384': hashlib.sha384,
-            '512': hashlib.sha512,
-            '3_224': hashlib.sha3_224,
-            '3_256': hashlib.sha3_256,
-            '3_384': hashlib.sha3_384,
-            '3_512': hashlib.sha3_512,
-        }
-        if abstraction is not None:
-            checksumer = sha_levels[abstraction]()
-        else:
-            checksumer = sha_levels['256']()
-        for chunk in cls._iter_read(filename, chunk_size):
-            checksumer.update(chunk)
+    def sha_sum(cls, filename, *, constructor=hashlib.sha256) -> str:
+        checksumer = constructor()
+        if not cls.read_engine.update(checksumer, filename):
+            return ''
         file_hash = checksumer.hexdigest()
         return str(file_hash)
 
+    # Builtin filters taking the size of their digest as a modifier
     @staticmethod
-    def partial_md5_sum(filename, chunk_size=65536, chunks_read=200) -> str:
+    def digests():
+        return {
+            "sha"   : OrderedDict([
+                ('1', hashlib.sha1),
+                ('224', hashlib.sha224),
+                ('256', hashlib.sha256),
+                ('384', hashlib.sha384),
+                ('512', hashlib.sha512),
+                ('3_224', hashlib.sha3_224),
+                ('3_256', hashlib.sha3_256),
+                ('3_384', hashlib.sha3_384),
+                ('3_512', hashlib.sha3_512),
+            ]),
+            "blake2": OrderedDict((str(size), partial(hashlib.blake2b, digest_size=size))
+                                  for size in range(1, 65)),
+            "xxh3"  : OrderedDict([
+                ('64', getattr(xxhash, "xxh3_64", None)),
+                ('128', getattr(xxhash, "xxh3_128", None)),
+            ]),
+        }
+
+    @classmethod
+    def _digest_constructor(cls, func_name, abstraction):
+        levels = cls.digests()[func_name]
+        try:
+            return levels[abstraction]
+        except KeyError as e:
+            log.error("Modifier {} is not valid".format(e))
+            print("Valid Keys:", *levels.keys(), sep='\n  ')
+            exit(1)
+
+    # Group filters are given a whole group of files at once, returning an output per file
+    @staticmethod
+    def group_filter(filter_func):
+        return getattr(filter_func, "group", None)
+
+    # Files are compared to each other a group at a time, rather than checksummed.
+    # Where files are filtered one at a time (--incremental), falls back to md5.
+    # Files are grouped by size first, so only files of the same size are read side by side
+    @classmethod
+    def compare_filter(cls):
+        compare = cls._with_spec(cls.md5_sum, "compare")
+        compare.group = cls.compare_group
+        return FilterChain((
+            cls._with_batch(cls._with_spec(cls.disk_size, "size"), "size"),
+            compare,
+        ))
+
+    # Each output is the number of a subgroup of identical files, unique within a run
+    @classmethod
+    def compare_group(cls, filenames) -> list:
+        labels = cls.read_engine.compare(filenames, subgroups=cls._compare_subgroups)
+        return ['' if label is None else str(label) for label in labels]
+
+    # Digest size in bytes, 16 by default. Much faster than md5 or sha on 64 bit machines
+    @classmethod
+    def blake2_sum(cls, filename, *, constructor=partial(hashlib.blake2b, digest_size=16)) -> str:
+        checksumer = constructor()
+        if not cls.read_engine.update(checksumer, filename):
+            return ''
+        return checksumer.hexdigest()
+
+    # Non cryptographic, 64 or 128 bits (default). Pair with --verify to rule out collisions
+    @classmethod
+    def xxh3_sum(cls, filename, *, constructor=None) -> str:
+        if constructor is None:
+            constructor = xxhash.xxh3_128
+        checksumer = constructor()
+        if not cls.read_engine.update(checksumer, filename):
+            return ''
+        return checksumer.hexdigest()
+
+    @classmethod
+    def partial_md5_sum(cls, filename, chunk_size=65536, chunks_read=200) -> str:
         checksumer = hashlib.md5()
-        with open(filename, 'rb') as file:
-            for null in range(0, chunks_read):
-                chunk = file.read(chunk_size)
-                if chunk == b'':
-                    break
-                checksumer.update(chunk)
+        if not cls.read_engine.update(checksumer, filename, [(0, chunk_size * chunks_read)]):
+            return ''
         return checksumer.hexdigest()
 
     @classmethod
-    def _datetime_round(cls, datetime_, abstraction=None) -> str:
+    def _datetime_rounding(cls, abstraction):
+        if '%' in abstraction:
+            return methodcaller('strftime', abstraction)
+
         aliases = cls.aliases("datetime_round")
         rounding_level = {
-            'MICRO'  : lambda dt: dt.strftime('%f'),
-            'SECOND' : lambda dt: dt.strftime('%S'),
-            'MINUTE' : lambda dt: dt.strftime('%M'),
-            'HOUR'   : lambda dt: dt.strftime('%H'),
-            'DAY'    : lambda dt: dt.strftime('%d'),
-            'MONTH'  : lambda dt: dt.strftime('%m'),
-            'YEAR'   : lambda dt: dt.strftime('%Y'),
-            'WEEKDAY': lambda dt: dt.strftime('%A'),
+            'MICROSECOND': '%f',
+            'SECOND'     : '%S',
+            'MINUTE'     : '%M',
+            'HOUR'       : '%H',
+            'DAY'        : '%d',
+            'MONTH'      : '%m',
+            'YEAR'       : '%Y',
+            'WEEKDAY'    : '%A',
         }
-        if '%' in abstraction:
-            rounded_datetime = datetime_.strftime(abstraction)
-        else:
-            try:
-                abstraction = aliases[abstraction.upper()]
-            except KeyError as e:
-                log.error("Modifier {} is not valid".format(e))
-                # Set used to remove duplicate values
-                print("Valid Keys:", *sorted(set(aliases.values())), sep='\n  ')
-                exit(1)
-            rounded_datetime = rounding_level[abstraction](datetime_)
-        return rounded_datetime
+        try:
+            abstraction = aliases[abstraction.upper()]
+        except KeyError as e:
+            log.error("Modifier {} is not valid".format(e))
+            # Set used to remove duplicate values
+            print("Valid Keys:", *sorted(set(aliases.values())), sep='\n  ')
+            exit(1)
+        return methodcaller('strftime', rounding_level[abstraction])
 
     @staticmethod
     def aliases(alias_type):
@@ -310,10 +660,46 @@ class ActionAppendFilePropertyFilter(ActionAppendCreateFunc):
 
 
 class DuplicateFilters:
-    def __init__(self, *, filters, filenames, conditions=None):
+    def __init__(self, *, filters, filenames, conditions=None, group_size=1,
+                 executor=None, cpu_executor=None, batch_size=512, chunk_size=64,
+                 pipeline=False, incremental=False, spill_dir=None, spill_records=1000000,
+                 filter_batch=1, shell_pool=None, reorder=True):
         self.filters = filters
+        # Filters are run in the order of plan, but their outputs
+        # are still labeled in the order they were given
+        if reorder is True:
+            self.plan = self._plan(filters)
+        else:
+            self.plan = list(range(len(filters)))
+        self._planned_filters = self._drop_repeated_size(self.plan)
         self.filenames = filenames
-        self.filter_hashes = defaultdict(list)
+        self.group_size = group_size
+        # Filters reading file contents are run on executor and filters bound by
+        # Python code on cpu_executor (e.g. a ProcessPoolExecutor), if given.
+        # Paths are submitted batch_size at a time, in chunks of chunk_size
+        self.executor = executor
+        self.cpu_executor = cpu_executor
+        self.batch_size = batch_size
+        self.chunk_size = chunk_size
+        # Shell filters are given filter_batch filenames per command
+        self.filter_batch = filter_batch
+        # or run on shell_pool (an AsyncShellPool), if given
+        self.shell_pool = shell_pool
+        # With pipeline, directory search, conditions and each filter run on
+        # their own thread, connected by bounded queues
+        self.pipeline = pipeline
+        # With incremental, groups are yielded as soon as they reach group_size
+        self.incremental = incremental
+        # With spill_dir, the first filter groups paths on disk, spill_records at a time
+        self.spill_dir = spill_dir
+        self.spill_records = spill_records
+        # Paths are kept as integer ids in a PathTable while grouping,
+        # and their filter outputs in a FilterHashes of that table
+        self.paths = PathTable()
+        self.filter_hashes = FilterHashes(self.paths)
+        self._chain_outputs = defaultdict(list)
+        # Paths found to be hard links of an earlier path, keyed by that path
+        self.links = dict()
         if conditions is None:
             self.conditions = list()
         else:
@@ -323,66 +709,460 @@ class DuplicateFilters:
         return self.process()
 
     def process(self):
-        initial_filter, *other_filters = self.filters
-        results = self._first_filter(initial_filter, self.filenames, conditions=self.conditions)
-        for additional_filter in other_filters:
-            results = self._additional_filters(additional_filter, results)
-        for group_list in results:
-            yield group_list
-
-    def _first_filter(self, func, paths, conditions):
-        grouped_groups = OrderedDefaultListDict()
+        (initial_filter, initial_chain), *other_filters = self._stages()
+        paths = self._pipe(self.filenames, "search")
+        if self.incremental is True:
+            # Groups are reported before every link of a file is known,
+            # so hard links are filtered as separate files
+            paths = self._pipe(self._candidates(paths, self.conditions), "conditions")
+            for group_list in stats.measure(self._incremental_filter(self._stages(), paths), "incremental"):
+                yield group_list
+            return
+
+        paths = self._pipe(self._collapse_links(self._candidates(paths, self.conditions)), "conditions")
+
+        results = self._pipe(self._first_filter(initial_filter, paths, chain=initial_chain),
+                             self._stage_name(1, initial_filter))
+        for filter_number, (additional_filter, chain) in enumerate(other_filters, start=2):
+            results = self._additional_filters(additional_filter, self._prune(results), chain=chain)
+            results = self._pipe(results, self._stage_name(filter_number, additional_filter))
+        for group_list in self._prune(results):
+            yield self._expand_links(group_list)
+
+    @staticmethod
+    def _stage_name(filter_number, func):
+        return "filter {} {}".format(filter_number, getattr(func, "spec", "")).strip()
+
+    def _pipe(self, stage, name):
+        stage = stats.measure(stage, name)
+        if self.pipeline is True:
+            return background(stage, name=name)
+        return stage
+
+    @staticmethod
+    def _candidates(paths, conditions):
         for path in paths:
             if all(condition(path) for condition in conditions):
-                item_hash = func(path).strip()
-                log.debug("{path}:{spaces} {hash}".format(
-                    path=sanitize_object(path),
-                    spaces=' ' * (50 - len(sanitize_object(path))),
-                    hash=sanitize_object(item_hash)))
-
-                # If matching _whitespace or length of 0, continue since it shouldn't be
-                # considered a valid output, however will only check for values less then 10 (for performance)
-                if len(item_hash) < 10:
-                    if len(item_hash) == 0:
-                        continue
-                    elif _whitespace.match(str(item_hash)):
-                        continue
-
-                self.filter_hashes[path].append(item_hash)
-                grouped_groups[item_hash].append(path)
+                yield path
+
+    # Paths sharing an inode are one physical file. Only the first path found
+    # is filtered, the others are reported after it. Only files with
+    # more than one link are remembered
+    def _collapse_links(self, paths):
+        inodes = dict()
+        for path in paths:
+            try:
+                stat = file_stat(path)
+            except OSError:
+                yield path
+                continue
+            if stat.st_nlink > 1:
+                inode = (stat.st_dev, stat.st_ino)
+                representative = inodes.get(inode)
+                if representative is not None:
+                    log.debug("{} is a hard link of {}".format(sanitize_object(path),
+                                                                sanitize_object(representative)))
+                    self.links.setdefault(representative, list()).append(path)
+                    continue
+                inodes[inode] = str(path)
+            yield path
+
+    def _expand_links(self, group_list):
+        if not self.links:
+            return group_list
+        expanded_group = list()
+        for path in group_list:
+            expanded_group.append(path)
+            expanded_group.extend(self.links.get(str(path), ()))
+        return expanded_group
+
+    # Each filter splits groups on its own, so the groups found are the same in
+    # any order. Filters are ordered by cost over the share of files they split
+    # apart, as each only runs on the files the previous ones left grouped
+    @staticmethod
+    def _plan(filters):
+        def rank(filter_number):
+            cost, selectivity = ActionAppendFilePropertyFilter.filter_cost(filters[filter_number])
+            return cost / max(1 - selectivity, 0.01)
+        plan = sorted(range(len(filters)), key=rank)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Filter plan: {}".format(' -> '.join(
+                "f{} {}".format(filter_number + 1, DuplicateFilters._filter_spec(filters[filter_number]))
+                for filter_number in plan)))
+        return plan
+
+    @staticmethod
+    def _filter_spec(filter_func):
+        if isinstance(filter_func, FilterChain):
+            return getattr(filter_func[-1], "spec", "").split("::", 1)[0]
+        return getattr(filter_func, "spec", "")
+
+    # The filter outputs of path, in the order the filters were given.
+    # Integer keys are turned back into the filter's usual output
+    def labels(self, path):
+        labels = (self.label(path, filter_number) for filter_number in range(len(self.filters)))
+        return [label for label in labels if label is not None]
+
+    # The output of one filter for path, None if it has none
+    # With find=False, an output not found yet is left as None instead of running the filters for it
+    def label(self, path, filter_number, find=True):
+        position = self.plan.index(filter_number)
+        outputs = self.filter_hashes[path]
+        if len(outputs) <= position and find is True:
+            outputs = self._remaining_outputs(path, outputs, position + 1)
+        if len(outputs) <= position:
+            return None
+        output = outputs[position]
+        label = getattr(self.filters[filter_number], "label", None)
+        if label is not None and isinstance(output, int):
+            output = label(output)
+        return output
+
+    # The filters in plan order. A chain starting with the size of a file (progressive_md5)
+    # doesn't repeat it after a size filter, e.g. the default size, progressive_md5
+    def _drop_repeated_size(self, plan):
+        planned_filters = list()
+        size_known = False
+        for filter_ in (self.filters[filter_number] for filter_number in plan):
+            if isinstance(filter_, FilterChain):
+                if size_known and len(filter_) > 1 and getattr(filter_[0], "spec", None) == "size":
+                    filter_ = FilterChain(filter_[1:])
+            elif getattr(filter_, "spec", None) == "size":
+                size_known = True
+            planned_filters.append(filter_)
+        return planned_filters
+
+    # Groups of one aren't given to the filters after they split off, their
+    # remaining outputs are only found once their labels are asked for
+    def _remaining_outputs(self, path, outputs, count):
+        file_id = self.paths.find(path)
+        for filter_ in self._planned_filters[len(outputs):count]:
+            if isinstance(filter_, FilterChain):
+                chain = filter_
+                stages = chain[len(self._chain_outputs.get(file_id, ())):]
+            else:
+                chain, stages = None, (filter_,)
+            for stage in stages:
+                group_list, group_outputs = next(self._map_groups(stage, [[path]]))
+                output = _strip(group_outputs[0])
+                if _blank(output):
+                    return self.filter_hashes[path]
+                self._record(path, output, chain)
+        return self.filter_hashes[path]
+
+    # Expands each FilterChain into its stages, keeping which chain it belongs to
+    def _stages(self):
+        stages = list()
+        for filter_ in self._planned_filters:
+            if isinstance(filter_, FilterChain):
+                stages.extend((stage, filter_) for stage in filter_)
+            else:
+                stages.append((filter_, None))
+        return stages
+
+    # Chains are reported as a single filter output once their last stage has run
+    def _record(self, path, item_hash, chain=None):
+        if chain is None:
+            self.filter_hashes.append(path, item_hash)
+        else:
+            file_id = self.paths.add(path)
+            chain_outputs = self._chain_outputs[file_id]
+            chain_outputs.append(item_hash)
+            if len(chain_outputs) == len(chain):
+                self.filter_hashes.append(path, chain.label(chain_outputs))
+                del self._chain_outputs[file_id]
+
+    def _prune(self, groups):
+        # Filters only ever split groups, so a group already smaller than
+        # group_size can never be reported. Dropping it here keeps the
+        # following (often expensive) filters from reading those files
+        for group_list in groups:
+            if len(group_list) >= max(self.group_size, 1):
+                yield group_list
+            else:
+                log.debug("Pruned group of {} below group size".format(len(group_list)))
+                for path in group_list:
+                    self._chain_outputs.pop(self.paths.find(path), None)
+
+    def _executor_for(self, func):
+        if ActionAppendFilePropertyFilter.reads_content(func):
+            return self.executor
+        elif ActionAppendFilePropertyFilter.cpu_bound(func):
+            return self.cpu_executor
+        return None
+
+    # Yields (path, func(path)) in the order of paths
+    def _map(self, func, paths):
+        render_func = getattr(func, "render", None)
+        if render_func is not None and self.shell_pool is not None:
+            if self.filter_batch > 1:
+                yield from self._map_pool_batches(render_func, paths)
+                return
+            # Commands for the next paths are started while waiting on the current one
+            commands = ((path, self.shell_pool.submit(render_func(path))) for path in paths)
+            for path, command in lookahead(commands, self.shell_pool.jobs * 2):
+                yield path, self.shell_pool.result(command)
+            return
+
+        batch_func = getattr(func, "batch", None)
+        # Shell filters are only batched when asked to, builtin filters always are.
+        # A batched builtin filter (e.g. modified::DAY) is never given to cpu_executor,
+        # computing its keys a batch at a time is faster than a call per path in a process
+        if render_func is not None:
+            batch_size = self.filter_batch
+        else:
+            batch_size = self.batch_size
+        if batch_func is not None and batch_size > 1:
+            paths = iter(paths)
+            while True:
+                batch = list(islice(paths, batch_size))
+                if not batch:
+                    break
+                yield from zip(batch, batch_func(batch))
+            return
+
+        executor = self._executor_for(func)
+        if executor is None:
+            for path in paths:
+                yield path, func(path)
+            return
+
+        # Submitting the next batch before returning the current one keeps
+        # the executor busy while results are consumed
+        paths = iter(paths)
+        pending = None
+        while True:
+            batch = list(islice(paths, self.batch_size))
+            if not batch:
+                break
+            results = zip(batch, executor.map(func, batch, chunksize=self.chunk_size))
+            if pending is not None:
+                yield from pending
+            pending = results
+        if pending is not None:
+            yield from pending
+
+    # Runs a command per filter_batch paths on the shell pool, splitting its output like
+    # invoke_shell_batch. A batch whose line count doesn't match is run a path at a time
+    def _map_pool_batches(self, render_func, paths):
+        paths = iter(paths)
+        batches = iter(lambda: list(islice(paths, self.filter_batch)), [])
+        commands = ((batch, self.shell_pool.submit(render_func(batch))) for batch in batches)
+        for batch, command in lookahead(commands, self.shell_pool.jobs * 2):
+            lines = self.shell_pool.result(command).splitlines()
+            if len(lines) == len(batch):
+                yield from zip(batch, lines)
+                continue
+            log.debug("Command gave {lines} lines for {files} files, running each file separately".format(
+                lines=len(lines),
+                files=len(batch)))
+            path_commands = [self.shell_pool.submit(render_func(path)) for path in batch]
+            for path, path_command in zip(batch, path_commands):
+                yield path, self.shell_pool.result(path_command)
+
+    # Yields (group_list, outputs) with func mapped over every path of each group.
+    # Paths of consecutive groups are mapped together, so small groups still fill a batch
+    # With skip_single, groups of one are yielded in their place with None as outputs
+    def _map_groups(self, func, groups, skip_single=False):
+        min_size = 2 if skip_single is True else 1
+        group_func = ActionAppendFilePropertyFilter.group_filter(func)
+        if group_func is not None:
+            groups = (group_list for group_list in groups if len(group_list) > 0)
+            if self.executor is None:
+                for group_list in groups:
+                    if len(group_list) < min_size:
+                        yield group_list, None
+                    else:
+                        yield group_list, group_func(group_list)
+            else:
+                # The next groups are started while waiting on the current one
+                futures = ((group_list, self.executor.submit(group_func, group_list))
+                           if len(group_list) >= min_size else (group_list, None)
+                           for group_list in groups)
+                for group_list, future in lookahead(futures, self.batch_size):
+                    yield group_list, None if future is None else future.result()
+            return
+
+        pending_groups = deque()
+
+        def group_paths():
+            for group_list in groups:
+                if len(group_list) > 0:
+                    pending_groups.append(group_list)
+                    if len(group_list) >= min_size:
+                        yield from group_list
+
+        outputs = list()
+        for path, output in self._map(func, group_paths()):
+            while len(pending_groups[0]) < min_size:
+                yield pending_groups.popleft(), None
+            outputs.append(output)
+            if len(outputs) == len(pending_groups[0]):
+                yield pending_groups.popleft(), outputs
+                outputs = list()
+        while pending_groups:
+            yield pending_groups.popleft(), None
+
+    def _first_filter(self, func, paths, chain=None):
+        if self.spill_dir is not None:
+            for group_list in self._spilled_first_filter(func, paths, chain=chain):
+                yield group_list
+            return
+
+        # A plain dict keeps insertion order too, without an OrderedDict's links per entry
+        grouped_groups = dict()
+        # Paths in a group of two or more keep their FileEntry, so later filters reuse its stat results.
+        # A group's first path only keeps its stat result, as most never get a second path
+        entries = dict()
+        first_stats = StatTable()
+        for path, item_hash in self._first_filter_outputs(func, paths):
+            self._record(path, item_hash, chain)
+            # Groups hold file ids rather than paths until they are yielded. Most
+            # groups never get a second file, so a lone id isn't put in an array.
+            # Hex digests are kept as raw bytes
+            key = compact_output(item_hash)
+            file_id = self.paths.add(path)
+            file_ids = grouped_groups.get(key)
+            if file_ids is None:
+                grouped_groups[key] = file_id
+                if isinstance(path, FileEntry) and path.cached_stat() is not None:
+                    first_stats.set(file_id, path.cached_stat())
+            elif isinstance(file_ids, int):
+                grouped_groups[key] = array('L', (file_ids, file_id))
+                entries[file_id] = path
+            else:
+                file_ids.append(file_id)
+                entries[file_id] = path
         for key, group in grouped_groups.items():
+            if isinstance(group, int):
+                group = (group,)
             if len(group) > 0:
                 # key is appended enclosed in a list to group it, allowing other filters to also append to that
                 # specific group
-                yield group
+                first_id, *other_ids = group
+                first_path = FileEntry(self.paths[first_id], stat_result=first_stats.get(first_id))
+                yield [first_path] + [self._entry(entries.pop(file_id, None) or self.paths[file_id])
+                                      for file_id in other_ids]
 
-    def _additional_filters(self, func, groups):
-        for group_list in groups:
+    # A path read back from the path table or a spill run is a plain string.
+    # As a FileEntry, the filters after the first share one stat of it
+    @staticmethod
+    def _entry(path):
+        if isinstance(path, FileEntry):
+            return path
+        return FileEntry(path)
+
+    # Groups by sorting (output, path) records in runs on disk and merging them.
+    # Paths only enter the path table once they are in a group that can be
+    # reported, so memory doesn't grow with the number of files.
+    # Groups come out sorted by the first filter's output
+    def _spilled_first_filter(self, func, paths, chain=None):
+        records = ((item_hash, str(path)) for path, item_hash in self._first_filter_outputs(func, paths))
+        for item_hash, group in external_group(records,
+                                               spill_dir=self.spill_dir,
+                                               run_size=self.spill_records):
+            if len(group) < self.group_size:
+                continue
+            for path in group:
+                self._record(path, item_hash, chain)
+            yield [self._entry(path) for path in group]
+
+    def _first_filter_outputs(self, func, paths):
+        if ActionAppendFilePropertyFilter.group_filter(func) is not None:
+            # Every path is a single group
+            outputs = ((path, output)
+                       for group_list, group_outputs in self._map_groups(func, [list(paths)])
+                       for path, output in zip(group_list, group_outputs))
+        else:
+            outputs = self._map(func, paths)
+        for path, item_hash in outputs:
+            item_hash = _strip(item_hash)
+            log.debug("{path}:{spaces} {hash}".format(
+                path=sanitize_object(path),
+                spaces=' ' * (50 - len(sanitize_object(path))),
+                hash=sanitize_object(item_hash)))
+
+            # If matching _whitespace or length of 0, continue since it shouldn't be
+            # considered a valid output
+            if _blank(item_hash):
+                continue
+            yield path, item_hash
+
+    # Every filter is run on each path as it arrives, placing it in a tree of groups,
+    # and a group is yielded once it reaches group_size. Paths joining a group
+    # afterwards are yielded at the end, after the group's first path.
+    # Filters are only run on a path once another path shares its group so far
+    def _incremental_filter(self, stages, paths):
+        group_size = max(self.group_size, 1)
+        root = _IncrementalNode()
+        late_groups = list()
+
+        for path in paths:
+            for group_list in self._incremental_insert(root, path, stages, group_size, late_groups):
+                yield group_list
+
+        # Final reconciliation, reporting the paths found after their group
+        for leaf in late_groups:
+            log.debug("Updated group")
+            yield LateGroup(leaf.late_members, leaf.members[0])
+
+    def _incremental_insert(self, node, path, stages, group_size, late_groups, level=0):
+        if level == len(stages):
+            if len(node.members) < group_size:
+                node.members.append(path)
+                if len(node.members) == group_size:
+                    yield list(node.members)
+            else:
+                if not node.late_members:
+                    late_groups.append(node)
+                node.late_members.append(path)
+            return
+
+        if group_size > 1 and not node.children and node.pending is None:
+            node.pending = path
+            return
+
+        if node.pending is not None:
+            paths, node.pending = [node.pending, path], None
+        else:
+            paths = [path]
+        func, chain = stages[level]
+        for path, item_hash in self._map(func, paths):
+            item_hash = _strip(item_hash)
+            if _blank(item_hash):
+                continue
+            self._record(path, item_hash, chain)
+
+            child = node.children.get(item_hash)
+            if child is None:
+                child = node.children[item_hash] = _IncrementalNode()
+            for group_list in self._incremental_insert(child, path, stages, group_size, late_groups, level + 1):
+                yield group_list
+
+    def _additional_filters(self, func, groups, chain=None):
+        for group_list, item_hashes in self._map_groups(func, groups, skip_single=True):
+            # A group of one can't be split any further
+            if item_hashes is None:
+                yield group_list
+                continue
             unmatched_groups = OrderedDefaultListDict()
             filtered_groups = list()
-            if len(group_list) > 0:
-                first, *others = group_list
-                filtered_groups.append(first)
-                source_hash = func(first).strip()
-                self.filter_hashes[first].append(source_hash)
-
-                for item in others:
-                    item_hash = func(item).strip()
-
-                    # If matching _whitespace, continue since it shouldn't be considered a valid
-                    # output, however will only check for values less then 10 (for performance)
-                    if len(item_hash) < 10:
-                        if len(item_hash) == 0:
-                            continue
-                        elif _whitespace.match(str(item_hash)):
-                            continue
-
-                    self.filter_hashes[item].append(item_hash)
-                    # If this item matches the source, include it in the list to be returned.
-                    if item_hash == source_hash:
-                        filtered_groups.append(item)
-                    else:
-                        unmatched_groups[item_hash].append(item)
+            # The first file with a valid output is the source the others are matched against
+            source_hash = None
+            for item, item_hash in zip(group_list, item_hashes):
+                item_hash = _strip(item_hash)
+
+                # If matching _whitespace, continue since it shouldn't be considered a valid output
+                if _blank(item_hash):
+                    continue
+
+                self._record(item, item_hash, chain)
+                # If this item matches the source, include it in the list to be returned.
+                if not filtered_groups or item_hash == source_hash:
+                    source_hash = item_hash
+                    filtered_groups.append(item)
+                else:
+                    unmatched_groups[item_hash].append(item)
 
             yield filtered_groups
             # Calls itself on all unmatched groups
@@ -5,17 +5,21 @@ import pprint
 import shutil
 from functools import partial
 
+from util.DirectorySearch import file_stat
 from util.Templates import ActionAppendCreateFunc
 from util.Templates import EscapedBraceExpansion
 from util.Templates import invoke_shell
+from util.Templates import render_shell
 from util.Templates import sanitize_object
 
 log = logging.getLogger(__name__)
 
 
 def print_results(filtered_group, *, basic_formatting=False, labeled_filters):
-    log.info(' -> '.join(' '.join(sanitize_object(filter_output).splitlines())
-                         for filter_output in labeled_filters.values()))
+    # Finding a label can mean reading the file, only the labels already known are shown
+    if log.isEnabledFor(logging.INFO):
+        log.info(' -> '.join(' '.join(sanitize_object(filter_output).splitlines())
+                             for filter_output in labeled_filters.known()))
     if basic_formatting is True:
         for grp in filtered_group:
             yield grp + '\n'
@@ -35,14 +39,46 @@ class ActionAppendExecShell(ActionAppendCreateFunc):
         shell_command = partial(self._group_invoke_shell, command=command_template_format)
         return shell_command
 
+    # Returns a wrapper of the -x group action submitting its commands to pool,
+    # any other group action is returned unchanged
+    @classmethod
+    def concurrent(cls, group_action, pool):
+        if cls.runs_shell(group_action):
+            return partial(group_action, pool=pool)
+        log.warning("Concurrent execution is only available to --exec-shell")
+        return group_action
+
+    # Whether group_action is a -x command
+    @classmethod
+    def runs_shell(cls, group_action):
+        return isinstance(group_action, partial) and group_action.func is cls._group_invoke_shell
+
+    @staticmethod
+    def _group_invoke_shell(filtered_group, command, labeled_filters, pool=None, **kwargs):
+        if pool is None:
+            return ActionAppendExecShell._group_outputs(filtered_group, command, labeled_filters, **kwargs)
+
+        # Every command of the group is started now, while outputs are
+        # returned in group order as they are read
+        outputs = [pool.submit(render_shell(file, command=command, labeled_filters=labeled_filters, **kwargs))
+                   for file in filtered_group]
+        return (sanitize_object(pool.result(output)) for output in outputs)
+
     @staticmethod
-    def _group_invoke_shell(filtered_group, command, labeled_filters, **kwargs):
+    def _group_outputs(filtered_group, command, labeled_filters, **kwargs):
         for file in filtered_group:
             output = invoke_shell(file, command=command, labeled_filters=labeled_filters, **kwargs)
             output = sanitize_object(output)
             yield output
 
 
+# Whether group_action keeps the first file of a group and replaces the others.
+# Files found after their group was reported (--incremental) are given to it
+# after the file it kept
+def keeps_first(group_action):
+    return group_action in (remove_files, hardlink_files)
+
+
 def remove_files(filtered_group: iter, labeled_filters, **kwargs):
     files_to_remove = filtered_group[1:]
     if len(files_to_remove) > 0:
@@ -68,6 +104,14 @@ def remove_files(filtered_group: iter, labeled_filters, **kwargs):
 
 def hardlink_files(filtered_group: iter, labeled_filters, **kwargs):
     source_file, *files_to_link = filtered_group
+    # Files already linked to source_file are left alone
+    try:
+        source_stat = file_stat(source_file)
+    except OSError:
+        log.warning("{} Not Found".format(sanitize_object(source_file)))
+        return None
+    files_to_link = [filename for filename in files_to_link
+                     if not _same_inode(source_stat, filename)]
     if len(files_to_link) > 0:
         warning_message = "Are you sure you wish to remove and hard link the following duplicate files?"
         print(warning_message)
@@ -90,6 +134,14 @@ def hardlink_files(filtered_group: iter, labeled_filters, **kwargs):
     return None
 
 
+def _same_inode(stat, filename):
+    try:
+        other_stat = file_stat(filename)
+    except OSError:
+        return False
+    return (stat.st_dev, stat.st_ino) == (other_stat.st_dev, other_stat.st_ino)
+
+
 class ActionAppendMerge(ActionAppendCreateFunc):
     @classmethod
     def overwrite_flags(cls):
@@ -139,7 +191,8 @@ class ActionAppendMerge(ActionAppendCreateFunc):
     @staticmethod
     def _abstract_call(filtered_group, *, merge_dir, overwrite_method, labeled_filters):
         filter_dir = os.path.join(merge_dir, *labeled_filters.values())
-        os.makedirs(filter_dir)
+        # Files found after their group was merged (--incremental) join its directory
+        os.makedirs(filter_dir, exist_ok=True)
         output = overwrite_method(filter_dir, filter_group=filtered_group)
         return output
 
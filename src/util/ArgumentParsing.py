@@ -1,7 +1,10 @@
+import argparse
 import os
 from functools import partial
 
 from util.ActionCreateFilter import ActionSelectFilter
+from util.FileRead import FileReader
+from util.FilterCache import default_cache_path
 from util.ActionCreateFunc import ActionAppendExecShell, \
     ActionAppendMerge, \
     remove_files, \
@@ -9,6 +12,14 @@ from util.ActionCreateFunc import ActionAppendExecShell, \
     print_results
 
 
+# A limit of 0 or less would stop every command
+def positive_float(value):
+    number = float(value)
+    if number <= 0:
+        raise argparse.ArgumentTypeError("{} is not greater than 0".format(value))
+    return number
+
+
 def parser_logic(parser):
     parser.add_argument('-f', '--filter',
                         dest="filters",
@@ -17,6 +28,53 @@ def parser_logic(parser):
                         action=ActionSelectFilter,
                         )
 
+    parser.add_argument('--verify',
+                        action='store_true',
+                        help="confirm groups with a sha256 checksum after the other filters\n"
+                             "only files still grouped are read again",
+                        )
+
+    parser.add_argument('--no-reorder',
+                        action='store_true',
+                        help="run filters in the order given\n"
+                             "rather than cheapest and most discriminating first",
+                        )
+
+    parser.add_argument('--filter-batch',
+                        metavar='N',
+                        type=int,
+                        default=1,
+                        help="run each shell filter on N files at once, with {}\n"
+                             "expanding to all of them. The command must output\n"
+                             "one line per file, in the same order",
+                        )
+
+    parser.add_argument('--filter-jobs',
+                        metavar='N',
+                        type=int,
+                        default=1,
+                        help="number of shell filter commands run at once",
+                        )
+
+    parser.add_argument('--shell-timeout',
+                        metavar='SECONDS',
+                        type=positive_float,
+                        help="stop shell filters and --exec-shell commands running\n"
+                             "longer than SECONDS, a stopped filter has no output",
+                        )
+
+    parser.add_argument('--shell-memory',
+                        metavar='MB',
+                        type=positive_float,
+                        help="memory limit of each shell filter and --exec-shell command",
+                        )
+
+    parser.add_argument('--shell-cpu',
+                        metavar='SECONDS',
+                        type=positive_float,
+                        help="CPU time limit of each shell filter and --exec-shell command",
+                        )
+
     parser.add_argument('-x', '--exec-shell',
                         dest="group_action",
                         metavar='COMMAND',
@@ -24,6 +82,14 @@ def parser_logic(parser):
                         action=ActionAppendExecShell,
                         )
 
+    parser.add_argument('--exec-jobs',
+                        metavar='N',
+                        type=int,
+                        default=1,
+                        help="number of --exec-shell commands run at once\n"
+                             "output is still shown in group order",
+                        )
+
     parser.add_argument('-m', '--exec-merge',
                         dest="group_action",
                         metavar="DIRECTORY",
@@ -50,10 +116,88 @@ def parser_logic(parser):
                         help='no indenting or empty newlines in standard output',
                         )
 
+    parser.add_argument('-j', '--jobs',
+                        metavar='N',
+                        type=int,
+                        default=1,
+                        help="number of files read at once by checksum filters",
+                        )
+
+    parser.add_argument('--cpu-jobs',
+                        metavar='N',
+                        type=int,
+                        default=1,
+                        help="number of processes running the filename filter, and\n"
+                             "modified and accessed with a strftime modifier",
+                        )
+
+    parser.add_argument('--pipeline',
+                        action='store_true',
+                        help="run directory search, conditions and each filter\n"
+                             "at the same time, each on its own thread",
+                        )
+
+    parser.add_argument('--incremental',
+                        action='store_true',
+                        help="report each group as soon as it reaches the group size\n"
+                             "files found later are reported at the end,\n"
+                             "after the first file of their group",
+                        )
+
+    parser.add_argument('--spill-dir',
+                        metavar='DIRECTORY',
+                        help="group files on disk in DIRECTORY rather than in memory\n"
+                             "for more files than fit in memory",
+                        )
+
+    parser.add_argument('--spill-records',
+                        metavar='N',
+                        type=int,
+                        default=1000000,
+                        help="number of files sorted in memory at once with --spill-dir",
+                        )
+
+    parser.add_argument('--cache',
+                        nargs='?',
+                        const=default_cache_path(),
+                        metavar='FILE',
+                        help="reuse checksum filter outputs of unchanged files\n"
+                             "between runs, default FILE is {}".format(default_cache_path()),
+                        )
+
+    parser.add_argument('--read-mode',
+                        choices=FileReader.modes,
+                        default='readinto',
+                        help="how checksum filters read files, default readinto\n"
+                             "mmap maps each file into memory instead of copying it",
+                        )
+
+    parser.add_argument('--read-size',
+                        metavar='BYTES',
+                        type=int,
+                        default=65536,
+                        help="smallest chunk read at once by checksum filters\n"
+                             "chunks grow with the file size, up to 4MB",
+                        )
+
+    parser.add_argument('--drop-cache',
+                        action='store_true',
+                        help="tell the kernel not to keep files in the page cache\n"
+                             "after they have been hashed",
+                        )
+
     parser.add_argument('-r', '--recursive',
                         action='store_true',
                         )
 
+    parser.add_argument('--walk-jobs',
+                        metavar='N',
+                        type=int,
+                        default=1,
+                        help="number of directories listed at once\n"
+                             "files are found in a different order each run",
+                        )
+
     parser.add_argument('--include',
                         action='append',
                         metavar='FILE',
@@ -99,6 +243,20 @@ def parser_logic(parser):
                         help="Minimum number of files in each group",
                         )
 
+    parser.add_argument('--stats',
+                        nargs='?',
+                        const='-',
+                        metavar='FILE',
+                        help="write where time was spent as JSON to FILE\n"
+                             "time, files, bytes read, stat and open calls\n"
+                             "and subprocesses of each stage, default is stderr",
+                        )
+
+    parser.add_argument('--progress',
+                        action='store_true',
+                        help="show counts of files found and bytes read on stderr",
+                        )
+
     parser.add_argument('-v', '--verbosity',
                         default=3,
                         action="count",
@@ -114,9 +272,13 @@ def parser_logic(parser):
 
 help_filter = """builtin filters
 modifiers with syntax filter:modifier
+  progressive_md5
   partial_md5
   md5
   sha     ::[1, 224, 256, 384, 512, 3_224, 3_256, 3_384, 3_512]
+  blake2  ::[1 - 64] digest bytes, default 16
+  xxh3    ::[64, 128] requires the xxhash module
+  compare
   modified::[MICROSECOND, SECOND, MINUTE, HOUR, DAY, MONTH, YEAR, WEEKDAY] | '%%DIRECTIVE'
   accessed::[MICROSECOND, SECOND, MINUTE, HOUR, DAY, MONTH, YEAR, WEEKDAY] | '%%DIRECTIVE'
   size    ::[B, KB, MB, GB, TB, PB]
@@ -128,6 +290,11 @@ shell filters
 filenames represented as {}: 
 example: -f \"du {} | cut -f1\"
          -f \"exiftool -p '\$DateTimeOriginal' {} | cut -d\: -f1\"
+
+coproc::COMMAND
+start COMMAND once, writing each filename to its input
+reading one line of output per filename
+example: -f \"coproc::while read f; do du -b \\\"\$f\\\" | cut -f1; done\"
 """
 
 help_exec_shell = """complete shell command on grouped files
@@ -0,0 +1,149 @@
+import calendar
+import math
+import time
+
+# NumPy is optional, batches are computed in Python without it.
+# It is only imported once a batch is large enough to use it
+_numpy = None
+
+# Smaller batches aren't worth converting to arrays
+_numpy_batch = 64
+
+# The struct_time attribute each datetime rounding keeps
+_time_fields = {
+    'HOUR'   : 'tm_hour',
+    'DAY'    : 'tm_mday',
+    'MONTH'  : 'tm_mon',
+    'YEAR'   : 'tm_year',
+    'WEEKDAY': 'tm_wday',
+}
+
+# The output of the modified and accessed filters for each rounding
+_date_formats = {
+    'MICROSECOND': '{:06d}',
+    'SECOND'     : '{:02d}',
+    'MINUTE'     : '{:02d}',
+    'HOUR'       : '{:02d}',
+    'DAY'        : '{:02d}',
+    'MONTH'      : '{:02d}',
+    'YEAR'       : '{}',
+}
+
+# Local time is looked up once per quarter hour: every UTC offset in use is a
+# multiple of it, so the local date and hour are the same throughout one
+_block_seconds = 900
+_local_blocks = dict()
+
+
+# Integer keys for file sizes, rounded to a multiple of divisor (e.g. 1024 ** 2) if given
+def size_keys(sizes, divisor=None) -> list:
+    if divisor is None:
+        return list(sizes)
+    numpy = _load_numpy(len(sizes))
+    if numpy is not None:
+        return numpy.rint(numpy.asarray(sizes, dtype=numpy.float64) / divisor).astype(numpy.int64).tolist()
+    return [int(round(size / divisor, 0)) for size in sizes]
+
+
+def size_label(key, unit=None) -> str:
+    if unit is None:
+        return str(key)
+    return "{}{}".format(key, unit)
+
+
+# Integer keys for timestamps (e.g. st_mtime), keeping one field of their local
+# time: MICROSECOND, SECOND, MINUTE, HOUR, DAY, MONTH, YEAR or WEEKDAY
+def date_keys(timestamps, field) -> list:
+    numpy = _load_numpy(len(timestamps))
+    if numpy is not None:
+        return _date_keys_numpy(numpy, timestamps, field)
+    return [_date_key(timestamp, field) for timestamp in timestamps]
+
+
+def date_label(key, field) -> str:
+    if field == 'WEEKDAY':
+        return calendar.day_name[key]
+    return _date_formats[field].format(key)
+
+
+def _load_numpy(batch_size):
+    global _numpy
+    if batch_size < _numpy_batch:
+        return None
+    if _numpy is None:
+        try:
+            import numpy
+            _numpy = numpy
+        except ImportError:
+            _numpy = False
+    return _numpy or None
+
+
+# The local time at the start of a quarter hour, None if its
+# UTC offset isn't whole quarter hours (e.g. local mean time)
+def _local_block(block):
+    local = _local_blocks.get(block)
+    if local is None:
+        local = time.localtime(block * _block_seconds)
+        if local.tm_gmtoff % _block_seconds != 0:
+            return None
+        if len(_local_blocks) > 65536:
+            _local_blocks.clear()
+        _local_blocks[block] = local
+    return local
+
+
+# Splits a timestamp into whole seconds and microseconds, rounded
+# half to even as datetime.fromtimestamp does
+def _split_timestamp(timestamp):
+    fraction, seconds = math.modf(timestamp)
+    seconds, microsecond = int(seconds), round(fraction * 1e6)
+    if microsecond >= 1000000:
+        seconds, microsecond = seconds + 1, microsecond - 1000000
+    elif microsecond < 0:
+        seconds, microsecond = seconds - 1, microsecond + 1000000
+    return seconds, microsecond
+
+
+def _date_key(timestamp, field):
+    seconds, microsecond = _split_timestamp(timestamp)
+    if field == 'MICROSECOND':
+        return microsecond
+    block, offset = divmod(seconds, _block_seconds)
+    local = _local_block(block)
+    if local is None:
+        local, offset = time.localtime(seconds), 0
+    if field == 'SECOND':
+        return local.tm_sec + offset % 60
+    elif field == 'MINUTE':
+        return local.tm_min + offset // 60
+    return getattr(local, _time_fields[field])
+
+
+def _date_keys_numpy(numpy, timestamps, field):
+    fraction, seconds = numpy.modf(numpy.asarray(timestamps, dtype=numpy.float64))
+    seconds = seconds.astype(numpy.int64)
+    microsecond = numpy.rint(fraction * 1e6).astype(numpy.int64)
+    seconds += numpy.where(microsecond >= 1000000, 1, 0) - numpy.where(microsecond < 0, 1, 0)
+    microsecond %= 1000000
+    if field == 'MICROSECOND':
+        return microsecond.tolist()
+
+    blocks, offsets = numpy.divmod(seconds, _block_seconds)
+    unique_blocks, inverse = numpy.unique(blocks, return_inverse=True)
+    local_blocks = [_local_block(int(block)) for block in unique_blocks]
+    if any(local is None for local in local_blocks):
+        return [_date_key(timestamp, field) for timestamp in timestamps]
+
+    inverse = inverse.reshape(-1)
+    if field == 'SECOND':
+        keys = offsets % 60
+    elif field == 'MINUTE':
+        keys = numpy.array([local.tm_min for local in local_blocks])[inverse] + offsets // 60
+    else:
+        keys = numpy.array([getattr(local, _time_fields[field]) for local in local_blocks])[inverse]
+    return keys.tolist()
+
+
+if __name__ == '__main__':
+    pass
@@ -1,58 +1,227 @@
+import fnmatch
 import logging
 import os
-import pathlib
+import re
+import stat
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+from functools import partial
+
+from util.Logging import stats
 
 log = logging.getLogger(__name__)
 
 
+# A path that keeps its stat results, so conditions and filters asking about
+# the same file share a single system call. It is otherwise a regular string
+class FileEntry(str):
+    def __new__(cls, path, dir_entry=None, stat_result=None):
+        entry = super().__new__(cls, path)
+        entry._dir_entry = dir_entry
+        entry._lstat = None
+        entry._stat = stat_result
+        return entry
+
+    # The result of stat if already known, without a system call
+    def cached_stat(self):
+        return self._stat
+
+    # os.DirEntry can't be pickled (e.g. to a process pool), the stat results can
+    def __reduce__(self):
+        state = {'_dir_entry': None, '_lstat': self._lstat, '_stat': self._stat}
+        return self.__class__, (str(self),), state
+
+    def lstat(self):
+        if self._lstat is None:
+            if self._dir_entry is not None:
+                self._lstat = self._dir_entry.stat(follow_symlinks=False)
+                stats.count('stat')
+                # Everything the directory entry knows is now in the stat result
+                self._dir_entry = None
+            else:
+                self._lstat = os.lstat(self)
+                stats.count('stat')
+        return self._lstat
+
+    def stat(self):
+        if self._stat is None:
+            lstat = self.lstat()
+            # Only a symbolic link needs a second call to stat its target
+            if stat.S_ISLNK(lstat.st_mode):
+                self._stat = os.stat(self)
+                stats.count('stat')
+            else:
+                self._stat = lstat
+        return self._stat
+
+    def is_file(self):
+        try:
+            return stat.S_ISREG(self.stat().st_mode)
+        except OSError:
+            return False
+
+    def is_symlink(self):
+        # The type of a directory entry is usually known without a system call
+        if self._dir_entry is not None:
+            return self._dir_entry.is_symlink()
+        try:
+            return stat.S_ISLNK(self.lstat().st_mode)
+        except OSError:
+            return False
+
+
+def file_stat(filename) -> os.stat_result:
+    if isinstance(filename, FileEntry):
+        return filename.stat()
+    stats.count('stat')
+    return os.stat(filename)
+
+
 def directory_search(directory: str, *,
                      recursive=True, max_depth=None, dir_hidden=None,
                      include=None, exclude=None,
                      dir_include=None, dir_exclude=None
                      ) -> tuple:
     orig_directory = os.path.expanduser(directory)
-    orig_directory_hidden = hidden_in_dir(directory)
-
-    directory_depth = 0
 
     if not os.path.isdir(orig_directory):
         for file in filenames_from_file(orig_directory):
             yield file
-    else:
-        for directory, subdir, files in os.walk(orig_directory):
+        return
 
-            # Skip hidden directories if specified
-            if all((
-                    dir_hidden is not True,
-                    orig_directory_hidden is not True,
-                    hidden_in_dir(directory))
-                    ):
-                continue
+    scan_directory = _directory_scanner(directory,
+                                        dir_hidden=dir_hidden,
+                                        include=compile_globs(include),
+                                        exclude=compile_globs(exclude),
+                                        dir_include=dir_include,
+                                        dir_exclude=dir_exclude,
+                                        )
 
-            # Check for included and excluded directories
-            # If directory matches, skip it
-            if dir_include or dir_exclude:
-                if not dir_include_exclude(directory, include=dir_include, exclude=dir_exclude):
-                    continue
-            if include or exclude:
-                for directory, file in file_include_exclude(files,
-                                                            directory=directory,
-                                                            include=include,
-                                                            exclude=exclude
-                                                            ):
-                    yield os.path.join(directory, file)
-            else:
+    # Depth first, visiting directories in the same order as os.walk
+    directories = [(orig_directory, 0)]
+    while directories:
+        directory, directory_depth = directories.pop()
+        files, subdirs = scan_directory(directory)
+        for file in files:
+            yield file
+
+        if _descend(directory_depth, recursive=recursive, max_depth=max_depth):
+            directories.extend((subdir, directory_depth + 1) for subdir in reversed(subdirs))
+
+
+# Lists directories of all given roots on a pool of jobs threads, keeping up to
+# 2 * jobs listings in flight. Useful on network filesystems, where listing a
+# directory is mostly waiting on the server.
+# Files are yielded as their directory is listed, so their order differs between runs
+def parallel_directory_search(directories, *, jobs,
+                              recursive=True, max_depth=None, dir_hidden=None,
+                              include=None, exclude=None,
+                              dir_include=None, dir_exclude=None
+                              ) -> tuple:
+    include = compile_globs(include)
+    exclude = compile_globs(exclude)
+
+    waiting = deque()
+    for directory in directories:
+        orig_directory = os.path.expanduser(directory)
+        if not os.path.isdir(orig_directory):
+            for file in filenames_from_file(orig_directory):
+                yield file
+            continue
+        scan_directory = _directory_scanner(directory,
+                                            dir_hidden=dir_hidden,
+                                            include=include,
+                                            exclude=exclude,
+                                            dir_include=dir_include,
+                                            dir_exclude=dir_exclude,
+                                            )
+        waiting.append((scan_directory, orig_directory, 0))
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        listings = dict()
+        while waiting or listings:
+            while waiting and len(listings) < jobs * 2:
+                scan_directory, directory, directory_depth = waiting.popleft()
+                listing = executor.submit(scan_directory, directory)
+                listings[listing] = (scan_directory, directory_depth)
+
+            done, not_done = wait(listings, return_when=FIRST_COMPLETED)
+            for listing in done:
+                scan_directory, directory_depth = listings.pop(listing)
+                files, subdirs = listing.result()
+                if _descend(directory_depth, recursive=recursive, max_depth=max_depth):
+                    waiting.extend((scan_directory, subdir, directory_depth + 1) for subdir in subdirs)
                 for file in files:
-                    yield os.path.join(directory, file)
+                    yield file
+
+
+def _directory_scanner(directory, *, dir_hidden, include, exclude, dir_include, dir_exclude):
+    # Hidden directories are kept when the searched directory is hidden itself
+    orig_directory_hidden = hidden_in_dir(directory)
+    scan_directory = partial(_scan_directory,
+                             dir_hidden=dir_hidden is True or orig_directory_hidden is True,
+                             include=include,
+                             exclude=exclude,
+                             dir_include=dir_include,
+                             dir_exclude=dir_exclude,
+                             )
+    return scan_directory
+
+
+# Only descend with recursive, and no further than max-depth
+def _descend(directory_depth, *, recursive, max_depth):
+    if recursive is False:
+        return False
+    if max_depth is not None and directory_depth >= max_depth:
+        return False
+    return True
+
+
+# Lists a single directory, returning its files as FileEntry objects
+# and the subdirectories to descend into
+def _scan_directory(directory, *, dir_hidden, include, exclude, dir_include, dir_exclude) -> tuple:
+    files, subdirs = list(), list()
+    try:
+        entries = list(os.scandir(directory))
+        stats.count('scandir')
+    except OSError as e:
+        log.warning("Unable to list {}: {}".format(directory, e.strerror))
+        return files, subdirs
+
+    # Check for included and excluded directories
+    # If directory doesn't match, skip its files but still descend into it
+    list_files = True
+    if dir_include or dir_exclude:
+        list_files = dir_include_exclude(directory, include=dir_include, exclude=dir_exclude)
+
+    for entry in entries:
+        try:
+            is_dir = entry.is_dir()
+        except OSError:
+            is_dir = False
+
+        if is_dir:
+            # Like os.walk, symbolic links to directories are not followed
+            # and not reported as files
+            if entry.is_symlink():
+                continue
+            if dir_hidden is not True and hidden_entry(entry):
+                continue
+            subdirs.append(entry.path)
+        elif list_files and file_include_exclude(entry.name, include=include, exclude=exclude):
+            files.append(FileEntry(entry.path, entry))
+    return files, subdirs
 
-            # Break after 1st iteration to prevent recursiveness
-            # If max-depth is specified, break after specified number
-            if recursive is False:
-                break
-            elif max_depth is int and max_depth > 0:
-                directory_depth += 1
-                if directory_depth == max_depth:
-                    break
+
+# Translates shell style globs into one regular expression matching a filename
+def compile_globs(globs):
+    if not globs:
+        return None
+    flags = re.IGNORECASE if os.name == 'nt' else 0
+    expression = '|'.join('(?:{})'.format(fnmatch.translate(glob_match)) for glob_match in globs)
+    return re.compile(expression, flags)
 
 
 def dir_include_exclude(directory, *, include=None, exclude=None):
@@ -73,25 +242,20 @@ def dir_include_exclude(directory, *, include=None, exclude=None):
         return True
 
 
-def file_include_exclude(files, *, directory, include, exclude):
-    if include:
-        included_filenames = {file for glob_match in include
-                              for file in files
-                              if pathlib.PurePath(file).match(glob_match)}
-    else:
-        included_filenames = set()
-    if exclude:
-        excluded_filenames = {file for glob_match in exclude
-                              for file in files
-                              if pathlib.PurePath(file).match(glob_match)}
-    else:
-        excluded_filenames = set()
+def file_include_exclude(filename, *, include=None, exclude=None):
+    if include is None and exclude is None:
+        return True
+    if include is not None and include.match(filename):
+        return True
+    elif exclude is not None and not exclude.match(filename):
+        return True
+    return False
 
-    for file in files:
-        if file in included_filenames:
-            yield (directory, file)
-        elif file not in excluded_filenames and len(excluded_filenames) > 0:
-            yield (directory, file)
+
+def hidden_entry(entry):
+    if os.name == 'nt':
+        return hidden_in_dir(entry.path)
+    return entry.name.startswith('.') and not entry.name.startswith('..')
 
 
 def hidden_in_dir(directory):
@@ -131,7 +295,7 @@ def filenames_from_file(file):
 
         log.info("Reading from '{file}'".format(file=file))
         if os.path.exists(initial_line):
-            yield initial_line
+            yield FileEntry(initial_line)
         else:
             print("Each line must be a filename")
             exit(1)
@@ -139,7 +303,7 @@ def filenames_from_file(file):
         for line in f:
             file = line.rstrip()
             if os.path.exists(file):
-                yield file
+                yield FileEntry(file)
             else:
                 log.warning("File '{}' not found, skipping".format(file))
 
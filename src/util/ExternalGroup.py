@@ -0,0 +1,63 @@
+import heapq
+import logging
+import pickle
+import tempfile
+from itertools import groupby, islice
+
+log = logging.getLogger(__name__)
+
+
+# Groups (key, value) records by key like an external sort, for more records than fit
+# in memory. Records are sorted in runs of run_size and written to temporary files
+# in spill_dir, then merged back, at most max_open runs at a time.
+# Yields (key, values) sorted by key, values of a key in the order they were given
+def external_group(records, *, spill_dir=None, run_size=1000000, max_open=64):
+    runs = list()
+    records = iter(records)
+    sequence = 0
+    while True:
+        run = list()
+        for key, value in islice(records, run_size):
+            run.append((key, sequence, value))
+            sequence += 1
+        if not run:
+            break
+        run.sort()
+        runs.append(_write_run(run, spill_dir))
+        log.debug("Spilled run {} of {} records".format(len(runs), len(run)))
+
+    # Merge runs into fewer, larger runs until they can all be open at once
+    while len(runs) > max_open:
+        merged_runs = [_read_run(run) for run in runs[:max_open]]
+        runs = runs[max_open:] + [_write_run(heapq.merge(*merged_runs), spill_dir)]
+
+    merged = heapq.merge(*(_read_run(run) for run in runs))
+    for key, group in groupby(merged, key=lambda record: record[0]):
+        yield key, [value for key_, sequence_, value in group]
+
+
+def _write_run(sorted_records, spill_dir, chunk_size=4096):
+    run = tempfile.TemporaryFile(dir=spill_dir)
+    sorted_records = iter(sorted_records)
+    while True:
+        chunk = list(islice(sorted_records, chunk_size))
+        if not chunk:
+            break
+        pickle.dump(chunk, run, protocol=pickle.HIGHEST_PROTOCOL)
+    run.seek(0)
+    return run
+
+
+def _read_run(run):
+    with run:
+        while True:
+            try:
+                chunk = pickle.load(run)
+            except EOFError:
+                break
+            for record in chunk:
+                yield record
+
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,183 @@
+import logging
+import mmap
+import os
+import threading
+from collections import OrderedDict
+from itertools import count
+
+from util.Logging import stats
+from util.Templates import sanitize_object
+
+log = logging.getLogger(__name__)
+
+
+# Feeds the contents of files to hash objects.
+# mode is one of
+#   read    : file.read, a new bytes object per chunk
+#   readinto: file.readinto, reusing one buffer per thread
+#   mmap    : the file is mapped into memory and hashed from it
+# Chunks grow with the amount read, from chunk_size up to max_chunk_size.
+# With drop_cache, the kernel is told the file won't be read again,
+# so hashing a large library doesn't push everything else out of the page cache
+class FileReader:
+    modes = ('read', 'readinto', 'mmap')
+
+    def __init__(self, mode='readinto', *, chunk_size=65536, max_chunk_size=4194304, drop_cache=False):
+        if mode not in self.modes:
+            raise ValueError("{} is not a valid read mode".format(mode))
+        self.mode = mode
+        self.chunk_size = chunk_size
+        self.max_chunk_size = max(chunk_size, max_chunk_size)
+        self.drop_cache = drop_cache
+        self._local = threading.local()
+
+    # Updates checksumer with the (start, stop) byte ranges of filename, or the
+    # whole file without ranges. Returns False if the file couldn't be read
+    def update(self, checksumer, filename, ranges=None) -> bool:
+        try:
+            with open(filename, 'rb', buffering=0) as file:
+                stats.count('open')
+                size = os.fstat(file.fileno()).st_size
+                # Read ahead a whole file, but not past the ranges of a partial read
+                if ranges is None:
+                    ranges = [(0, size)]
+                    self._advise(file, 'POSIX_FADV_SEQUENTIAL')
+                else:
+                    self._advise(file, 'POSIX_FADV_RANDOM')
+
+                chunk_size = self._chunk_size(max((min(stop, size) - start for start, stop in ranges), default=0))
+                if self.mode == 'mmap' and size > 0:
+                    self._update_mmap(checksumer, file, ranges, chunk_size)
+                elif self.mode == 'read':
+                    self._update_read(checksumer, file, ranges, chunk_size)
+                else:
+                    self._update_readinto(checksumer, file, ranges, chunk_size)
+
+                if self.drop_cache is True:
+                    self._advise(file, 'POSIX_FADV_DONTNEED')
+        except OSError as e:
+            log.warning("Unable to read {}: {}".format(sanitize_object(filename), e.strerror))
+            return False
+        return True
+
+    # Sized from the largest range read
+    def _chunk_size(self, size):
+        chunk_size = max(self.chunk_size, size // 8)
+        chunk_size = min(chunk_size, self.max_chunk_size)
+        # Keep chunks a multiple of the smallest chunk
+        return chunk_size - chunk_size % self.chunk_size
+
+    @staticmethod
+    def _advise(file, advice):
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(file.fileno(), 0, 0, getattr(os, advice))
+
+    @staticmethod
+    def _update_read(checksumer, file, ranges, chunk_size):
+        for start, stop in ranges:
+            file.seek(start)
+            remaining = stop - start
+            while remaining > 0:
+                chunk = file.read(min(chunk_size, remaining))
+                if chunk == b'':
+                    break
+                remaining -= len(chunk)
+                stats.count('bytes_read', len(chunk))
+                checksumer.update(chunk)
+
+    # The buffer of the calling thread, grown to hold chunk_size bytes
+    def _buffer(self, chunk_size):
+        buffer = getattr(self._local, 'buffer', None)
+        if buffer is None or len(buffer) < chunk_size:
+            buffer = self._local.buffer = memoryview(bytearray(chunk_size))
+        return buffer
+
+    def _update_readinto(self, checksumer, file, ranges, chunk_size):
+        buffer = self._buffer(chunk_size)
+        for start, stop in ranges:
+            file.seek(start)
+            remaining = stop - start
+            while remaining > 0:
+                read_size = file.readinto(buffer[:min(chunk_size, remaining)])
+                if not read_size:
+                    break
+                remaining -= read_size
+                stats.count('bytes_read', read_size)
+                checksumer.update(buffer[:read_size])
+
+    @staticmethod
+    def _update_mmap(checksumer, file, ranges, chunk_size):
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped_file:
+            mapped_view = memoryview(mapped_file)
+            try:
+                for start, stop in ranges:
+                    stop = min(stop, len(mapped_file))
+                    # Hashed a chunk at a time, each releasing the GIL
+                    for chunk_start in range(start, stop, chunk_size):
+                        checksumer.update(mapped_view[chunk_start:min(chunk_start + chunk_size, stop)])
+                    stats.count('bytes_read', max(stop - start, 0))
+            finally:
+                mapped_view.release()
+
+    # Compares files byte for byte, reading them side by side a chunk at a time.
+    # Files are split into subgroups as their contents diverge, and aren't read
+    # any further once alone. At most max_open files are kept open, others are
+    # reopened where they left off. Returns the subgroup number of each file
+    # (taken from subgroups), None for files which couldn't be read
+    def compare(self, filenames, *, subgroups=None, max_open=64):
+        if subgroups is None:
+            subgroups = count()
+        labels = [None] * len(filenames)
+        open_files = OrderedDict()
+
+        def read_at(member, offset, chunk_size):
+            file = open_files.pop(member, None)
+            if file is None:
+                if len(open_files) >= max_open:
+                    open_files.popitem(last=False)[1].close()
+                file = open(filenames[member], 'rb', buffering=0)
+                stats.count('open')
+            open_files[member] = file
+            file.seek(offset)
+            chunk = file.read(chunk_size)
+            stats.count('bytes_read', len(chunk))
+            return chunk
+
+        def close(member):
+            file = open_files.pop(member, None)
+            if file is not None:
+                file.close()
+
+        pending = [(list(range(len(filenames))), 0)]
+        try:
+            while pending:
+                members, offset = pending.pop()
+                # Every member's chunk is held at once, so large groups read less at a time
+                chunk_size = max(4096, min(self.chunk_size, self.max_chunk_size // len(members)))
+                chunks = OrderedDict()
+                for member in members:
+                    try:
+                        chunk = read_at(member, offset, chunk_size)
+                    except OSError as e:
+                        log.warning("Unable to read {}: {}".format(sanitize_object(filenames[member]), e.strerror))
+                        close(member)
+                        continue
+                    chunks.setdefault(chunk, list()).append(member)
+
+                for chunk, subgroup in chunks.items():
+                    # Alone, or every member ended together
+                    if len(subgroup) == 1 or chunk == b'':
+                        label = next(subgroups)
+                        for member in subgroup:
+                            labels[member] = label
+                            close(member)
+                    else:
+                        pending.append((subgroup, offset + len(chunk)))
+        finally:
+            for file in open_files.values():
+                file.close()
+        return labels
+
+
+if __name__ == '__main__':
+    pass
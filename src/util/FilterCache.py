@@ -0,0 +1,98 @@
+import atexit
+import logging
+import os
+import sqlite3
+import threading
+from functools import partial
+
+from util.ActionCreateFilter import ActionAppendFilePropertyFilter, FilterChain
+from util.DirectorySearch import file_stat
+from util.Templates import sanitize_object
+
+log = logging.getLogger(__name__)
+
+
+def default_cache_path():
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser(os.path.join("~", ".cache"))
+    return os.path.join(cache_home, "groupby", "filters.sqlite")
+
+
+# Stores the output of content filters per file, keyed by (device, inode, filter spec).
+# A stored output is only used while the file's size and modification time
+# are unchanged, otherwise it is computed again and replaced
+class FilterCache:
+    def __init__(self, path, *, commit_interval=1000):
+        self.path = os.path.expanduser(path)
+        self.commit_interval = commit_interval
+        self.hits = 0
+        self.misses = 0
+        self._pending_writes = 0
+
+        cache_dir = os.path.dirname(self.path)
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+        # Filters may be called from several threads, the connection is shared under a lock
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.path, check_same_thread=False)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS filter_output ("
+            " device INTEGER NOT NULL,"
+            " inode INTEGER NOT NULL,"
+            " spec TEXT NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " mtime_ns INTEGER NOT NULL,"
+            " output TEXT NOT NULL,"
+            " PRIMARY KEY (device, inode, spec))"
+        )
+        atexit.register(self.close)
+
+    # Returns filter_func reading through the cache. Filters that don't read
+    # file contents are cheaper than a lookup and returned unchanged
+    def wrap(self, filter_func):
+        if isinstance(filter_func, FilterChain):
+            return FilterChain(self.wrap(stage) for stage in filter_func)
+        if not ActionAppendFilePropertyFilter.reads_content(filter_func):
+            return filter_func
+        cached_func = partial(self._cached_call, filter_func=filter_func)
+        cached_func.spec = filter_func.spec
+        return cached_func
+
+    def _cached_call(self, filename, *, filter_func):
+        try:
+            stat = file_stat(filename)
+        except OSError:
+            return filter_func(filename)
+        key = (stat.st_dev, stat.st_ino, filter_func.spec)
+
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT size, mtime_ns, output FROM filter_output"
+                " WHERE device = ? AND inode = ? AND spec = ?", key).fetchone()
+            if row is not None and row[0] == stat.st_size and row[1] == stat.st_mtime_ns:
+                self.hits += 1
+                return row[2]
+            self.misses += 1
+
+        output = filter_func(filename)
+        if isinstance(output, str) and output:
+            with self._lock:
+                self._connection.execute(
+                    "INSERT OR REPLACE INTO filter_output VALUES (?, ?, ?, ?, ?, ?)",
+                    key + (stat.st_size, stat.st_mtime_ns, output))
+                self._pending_writes += 1
+                if self._pending_writes >= self.commit_interval:
+                    self._connection.commit()
+                    self._pending_writes = 0
+        return output
+
+    def close(self):
+        with self._lock:
+            if self._connection is None:
+                return
+            self._connection.commit()
+            self._connection.close()
+            self._connection = None
+        log.info("Cache {path}: {hits} hits, {misses} misses".format(
+            path=sanitize_object(self.path),
+            hits=self.hits,
+            misses=self.misses))
@@ -1,5 +1,10 @@
+import json
 import logging
-
+import sys
+import threading
+import time
+from collections import Counter
+from collections import OrderedDict
 from functools import wraps
 
 log_levels = {
@@ -27,3 +32,118 @@ def func_call(func):
             result=result))
         return result
     return wrapper_func
+
+
+# Counts work done during a run (system calls, bytes read, subprocesses) and
+# where time is spent, written as JSON with --stats. Counting does nothing until enabled.
+# Stages are measured while they produce each item, so a stage's time and counts include
+# the stages feeding it, and are split into its own share in the report.
+# The split is approximate when stages overlap (--pipeline, --jobs)
+class Stats:
+    def __init__(self):
+        self.enabled = False
+        self.counters = Counter()
+        self.stages = OrderedDict()
+        self._lock = threading.Lock()
+        self._start = time.perf_counter()
+        self._progress = None
+
+    def enable(self):
+        self.enabled = True
+        self._start = time.perf_counter()
+
+    def count(self, counter, amount=1):
+        if self.enabled:
+            with self._lock:
+                self.counters[counter] += amount
+
+    def measure(self, iterable, name):
+        if not self.enabled:
+            return iterable
+        # Stages are reported in the order they are set up
+        stage = self.stages.setdefault(name, dict(seconds=0.0, items=0, files=0, counters=Counter()))
+        return self._measure(iterable, stage)
+
+    def _measure(self, iterable, stage):
+        iterator = iter(iterable)
+        while True:
+            with self._lock:
+                counters_before = Counter(self.counters)
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                break
+            finally:
+                stage['seconds'] += time.perf_counter() - start
+                with self._lock:
+                    stage['counters'].update(self.counters)
+                stage['counters'].subtract(counters_before)
+            stage['items'] += 1
+            # Filters yield groups, earlier stages single paths
+            stage['files'] += len(item) if isinstance(item, list) else 1
+            yield item
+
+    def report(self, **extra) -> dict:
+        stages = list()
+        previous = None
+        for name, stage in self.stages.items():
+            own_counters = Counter(stage['counters'])
+            own_seconds = stage['seconds']
+            if previous is not None:
+                own_counters.subtract(previous['counters'])
+                own_seconds -= previous['seconds']
+            stages.append(dict(name=name,
+                               seconds=round(stage['seconds'], 6),
+                               own_seconds=round(max(own_seconds, 0.0), 6),
+                               items=stage['items'],
+                               files=stage['files'],
+                               own_counters={counter: value for counter, value in own_counters.items() if value > 0},
+                               ))
+            previous = stage
+        report = OrderedDict(seconds=round(time.perf_counter() - self._start, 6),
+                             counters=dict(self.counters),
+                             stages=stages)
+        report.update(extra)
+        return report
+
+    def write(self, filename, **extra):
+        output = json.dumps(self.report(**extra), indent=2)
+        if filename == '-':
+            print(output, file=sys.stderr)
+        else:
+            with open(filename, 'w') as file:
+                file.write(output + '\n')
+
+    # Rewrites a line of counters on stderr every interval seconds
+    def start_progress(self, interval=1.0):
+        stop = threading.Event()
+
+        def progress():
+            while not stop.wait(interval):
+                self._print_progress()
+
+        self._progress = stop
+        threading.Thread(target=progress, name="progress", daemon=True).start()
+
+    def stop_progress(self):
+        if self._progress is not None:
+            self._progress.set()
+            self._print_progress()
+            sys.stderr.write('\n')
+            self._progress = None
+
+    def _print_progress(self):
+        found = self.stages.get("search", dict()).get('items', 0)
+        with self._lock:
+            counters = dict(self.counters)
+        sys.stderr.write("\r{found} files found, {stat} stat, {open} opened, {read:.1f}MB read, "
+                         "{subprocess} subprocesses".format(found=found,
+                                                            stat=counters.get('stat', 0),
+                                                            open=counters.get('open', 0),
+                                                            read=counters.get('bytes_read', 0) / 1048576,
+                                                            subprocess=counters.get('subprocess', 0)))
+        sys.stderr.flush()
+
+
+stats = Stats()
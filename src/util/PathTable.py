@@ -0,0 +1,181 @@
+import os
+import re
+import threading
+from array import array
+from itertools import repeat
+
+# Filter outputs which are hex digests, stored as raw bytes
+_hex_digest = re.compile('^[0-9a-f]{32,128}$')
+
+
+# A hex digest output as raw bytes, half its size as a dictionary key.
+# Other outputs are returned unchanged
+def compact_output(output):
+    if isinstance(output, str) and _hex_digest.match(output) and len(output) % 2 == 0:
+        return bytes.fromhex(output)
+    return output
+
+
+# Assigns each path an integer id. Paths are stored as a directory id and a filename,
+# with each directory stored once
+class PathTable:
+    def __init__(self):
+        self._directories = list()
+        self._directory_ids = dict()
+        # Per directory, its filenames and their file ids
+        self._directory_files = list()
+        self._names = list()
+        self._name_directories = array('L')
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._names)
+
+    def __getitem__(self, file_id) -> str:
+        return self._directories[self._name_directories[file_id]] + self._names[file_id]
+
+    @staticmethod
+    def _split(path):
+        directory, separator, name = path.rpartition(os.sep)
+        return directory + separator, name
+
+    def find(self, path):
+        directory, name = self._split(path)
+        directory_id = self._directory_ids.get(directory)
+        if directory_id is None:
+            return None
+        return self._directory_files[directory_id].get(name)
+
+    # Returns the id of path, adding it if it isn't in the table yet
+    def add(self, path) -> int:
+        directory, name = self._split(path)
+        with self._lock:
+            directory_id = self._directory_ids.get(directory)
+            if directory_id is None:
+                directory_id = len(self._directories)
+                self._directory_ids[directory] = directory_id
+                self._directories.append(str(directory))
+                self._directory_files.append(dict())
+
+            directory_files = self._directory_files[directory_id]
+            file_id = directory_files.get(name)
+            if file_id is None:
+                # str() drops whatever a str subclass (e.g. FileEntry) carries
+                name = str(name)
+                file_id = len(self._names)
+                directory_files[name] = file_id
+                self._names.append(name)
+                self._name_directories.append(directory_id)
+        return file_id
+
+
+# Stat results by file id, kept in arrays rather than as os.stat_result objects.
+# Times are kept in nanoseconds, their float seconds computed as os.stat does
+class StatTable:
+    _fields = (('st_mode', 'I'), ('st_ino', 'Q'), ('st_dev', 'Q'), ('st_nlink', 'I'),
+               ('st_uid', 'I'), ('st_gid', 'I'), ('st_size', 'q'))
+    _times = ('st_atime', 'st_mtime', 'st_ctime')
+
+    def __init__(self):
+        self._columns = [(name, array(typecode)) for name, typecode in self._fields]
+        self._columns.extend((name + '_ns', array('q')) for name in self._times)
+
+    def set(self, file_id, stat_result):
+        for name, column in self._columns:
+            if file_id >= len(column):
+                column.extend(repeat(0, file_id + 1 - len(column)))
+            column[file_id] = getattr(stat_result, name)
+
+    # Only the fields above are kept, e.g. st_blocks is None.
+    # None for a file id never set, no file has a st_mode of 0
+    def get(self, file_id):
+        if file_id >= len(self._columns[0][1]) or self._columns[0][1][file_id] == 0:
+            return None
+        sequence = [column[file_id] for name, column in self._columns[:len(self._fields)]]
+        times = dict()
+        for name, (_, column) in zip(self._times, self._columns[len(self._fields):]):
+            seconds, nanoseconds = divmod(column[file_id], 1000000000)
+            sequence.append(seconds)
+            times[name] = seconds + nanoseconds * 1e-9
+            times[name + '_ns'] = column[file_id]
+        return os.stat_result(sequence, times)
+
+
+# The outputs of one filter position for every file. Repeated outputs (sizes, dates)
+# are stored once and referenced by id, hex digests are kept as raw bytes in one
+# bytearray. rows holds per file id: -1 for no output, a value id, or -2 - digest slot
+class _OutputColumn:
+    __slots__ = ('rows', 'values', 'value_ids', 'digests', 'digest_size')
+
+    def __init__(self):
+        self.rows = array('q')
+        self.values = list()
+        self.value_ids = dict()
+        self.digests = bytearray()
+        self.digest_size = None
+
+    def set(self, file_id, output):
+        if file_id >= len(self.rows):
+            self.rows.extend(repeat(-1, file_id + 1 - len(self.rows)))
+
+        if isinstance(output, str) and _hex_digest.match(output) and len(output) % 2 == 0:
+            digest = bytes.fromhex(output)
+            if self.digest_size is None:
+                self.digest_size = len(digest)
+            if len(digest) == self.digest_size:
+                slot = len(self.digests) // self.digest_size
+                self.digests.extend(digest)
+                self.rows[file_id] = -2 - slot
+                return
+
+        value_id = self.value_ids.get(output)
+        if value_id is None:
+            value_id = self.value_ids[output] = len(self.values)
+            self.values.append(output)
+        self.rows[file_id] = value_id
+
+    def get(self, file_id):
+        if file_id >= len(self.rows) or self.rows[file_id] == -1:
+            return None
+        row = self.rows[file_id]
+        if row >= 0:
+            return self.values[row]
+        start = (-2 - row) * self.digest_size
+        return self.digests[start:start + self.digest_size].hex()
+
+
+# Filter outputs of every path, in the order the filters ran.
+# filter_hashes[path] returns them as a list
+class FilterHashes:
+    def __init__(self, paths=None):
+        if paths is None:
+            paths = PathTable()
+        self.paths = paths
+        self._columns = list()
+        self._counts = array('B')
+        self._lock = threading.Lock()
+
+    def append(self, path, output):
+        file_id = self.paths.add(path)
+        with self._lock:
+            if file_id >= len(self._counts):
+                self._counts.extend(repeat(0, file_id + 1 - len(self._counts)))
+            position = self._counts[file_id]
+            if position == len(self._columns):
+                self._columns.append(_OutputColumn())
+            self._columns[position].set(file_id, output)
+            self._counts[file_id] = position + 1
+
+    def __getitem__(self, path) -> list:
+        file_id = self.paths.find(path)
+        if file_id is None or file_id >= len(self._counts):
+            return list()
+        return [self._columns[position].get(file_id)
+                for position in range(0, self._counts[file_id])]
+
+    def __contains__(self, path):
+        return len(self[path]) > 0
+
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,61 @@
+import queue
+import threading
+from collections import deque
+
+_end_of_stage = object()
+
+
+class _StageError:
+    def __init__(self, exception):
+        self.exception = exception
+
+
+# Runs iterable on its own thread, passing its items on through a bounded queue.
+# Items are sent in batches of batch_size to keep queue overhead low, and at most
+# maxsize batches wait in the queue; past that the stage blocks until the next
+# stage catches up. Exceptions (including exit()) are raised in the consumer
+def background(iterable, *, maxsize=64, batch_size=64, name=None):
+    batches = queue.Queue(maxsize=maxsize)
+
+    def produce():
+        try:
+            batch = list()
+            for item in iterable:
+                batch.append(item)
+                if len(batch) >= batch_size:
+                    batches.put(batch)
+                    batch = list()
+            if batch:
+                batches.put(batch)
+            batches.put(_end_of_stage)
+        except BaseException as e:
+            batches.put(_StageError(e))
+
+    # Daemon, so a stage still blocked on a full queue doesn't keep the program alive
+    stage = threading.Thread(target=produce, name=name, daemon=True)
+    stage.start()
+
+    while True:
+        batch = batches.get()
+        if batch is _end_of_stage:
+            break
+        elif isinstance(batch, _StageError):
+            raise batch.exception
+        for item in batch:
+            yield item
+
+
+# Keeps up to size items of iterable taken ahead of the one being returned,
+# e.g. so work started when each item is created runs concurrently
+def lookahead(iterable, size):
+    taken = deque()
+    for item in iterable:
+        taken.append(item)
+        if len(taken) > size:
+            yield taken.popleft()
+    while taken:
+        yield taken.popleft()
+
+
+if __name__ == '__main__':
+    pass
@@ -1,11 +1,19 @@
 import argparse
+import asyncio
+import atexit
 import codecs
 import logging
+import math
 import os
 import shlex
+import signal
 import string
 import subprocess
 import sys
+import threading
+from collections import ChainMap
+
+from util.Logging import stats
 
 log = logging.getLogger(__name__)
 
@@ -62,13 +70,21 @@ class BraceExpansion(string.Formatter):
         self.template = template
         for key, alias in self.aliases().items():
             self.template = self.template.replace(key, alias)
+        self._segments = self._compile(self.template)
 
     def __call__(self, *args, **kwargs):
-        log.debug("{} called with {} {}".format(
-            self.__repr__(),
-            sanitize_object(args),
-            sanitize_object(kwargs)))
-        return self.format(self.template, *args, **kwargs)
+        return self.render(args, kwargs)
+
+    # kwargs may be any mapping, only the fields in the template are looked up
+    def render(self, args, kwargs):
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("{} called with {} {}".format(
+                self.__repr__(),
+                sanitize_object(args),
+                sanitize_object(kwargs)))
+        if self._segments is None:
+            return self.vformat(self.template, args, kwargs)
+        return ''.join(self._render(args, kwargs))
 
     @classmethod
     def aliases(cls):
@@ -82,39 +98,71 @@ class BraceExpansion(string.Formatter):
         }
         return aliases
 
+    # The notation ending a spec, and what it does to the value
+    @staticmethod
+    def transforms():
+        transforms = {
+            # {} notation: normal output
+            'z': None,
+            # {.} notation: extension removed
+            'a': lambda value: os.path.splitext(value)[0],
+            # {/} notation: basename of file
+            'b': lambda value: os.path.split(value)[1],
+            # {//} notation: directory of filename
+            'c': lambda value: os.path.split(value)[0],
+            # {/.} notation: basename of file, with ext removed
+            'e': lambda value: os.path.splitext(os.path.split(value)[1])[0],
+            # {..} expanded notation: extension of file
+            'f': lambda value: os.path.splitext(value)[1],
+        }
+        return transforms
+
+    # The template is parsed once into its literal text and fields, each field
+    # with how to find its value and what to do with it. Templates with
+    # nested fields in a spec (e.g. {0:{f1}}) are formatted as usual instead
+    def _compile(self, template):
+        segments = list()
+        for literal_text, field_name, spec, conversion in self.parse(template):
+            if field_name is None:
+                segments.append((literal_text, None, None, None, None))
+                continue
+            if '{' in spec or field_name == '':
+                return None
+            transform, spec = self._split_spec(spec)
+            segments.append((literal_text, self._field_getter(field_name), conversion, transform, spec))
+        return segments
+
+    def _render(self, args, kwargs):
+        for literal_text, getter, conversion, transform, spec in self._segments:
+            yield literal_text
+            if getter is not None:
+                value = getter(args, kwargs)
+                if conversion is not None:
+                    value = self.convert_field(value, conversion)
+                yield self._format_value(value, transform, spec)
+
+    def _field_getter(self, field_name):
+        if field_name.isdigit():
+            index = int(field_name)
+            return lambda args, kwargs: args[index]
+        elif field_name.isidentifier():
+            return lambda args, kwargs: kwargs[field_name]
+        # Attributes and indexes, e.g. {f1[0]}
+        return lambda args, kwargs: self.get_field(field_name, args, kwargs)[0]
+
+    def _split_spec(self, spec):
+        if spec and spec[-1] in self.transforms():
+            return self.transforms()[spec[-1]], spec[:-1] + 's'
+        return None, spec
+
+    def _format_value(self, value, transform, spec):
+        if transform is not None:
+            value = transform(value)
+        return format(value, spec)
+
     def format_field(self, value, spec):
-        # {} notation: normal output
-        if spec.endswith("z"):
-            value = value
-            spec = spec[:-1] + 's'
-        # {.} notation: extension removed
-        if spec.endswith("a"):
-            split_ext = os.path.splitext(value)
-            value_no_ext = split_ext[0]
-            value = value_no_ext
-            spec = spec[:-1] + 's'
-        # {/} notation: basename of list()file
-        if spec.endswith("b"):
-            split_filename = os.path.split(value)[1]
-            value = split_filename
-            spec = spec[:-1] + 's'
-        # {//} notation: directory of filename)
-        if spec.endswith("c"):
-            split_dir = os.path.split(value)[0]
-            value = split_dir
-            spec = spec[:-1] + 's'
-        # {/.} notation: basename of file, with ext removed
-        if spec.endswith("e"):
-            no_dir = os.path.split(value)[1]
-            split_ext = os.path.splitext(no_dir)[0]
-            value = split_ext
-            spec = spec[:-1] + 's'
-        # {..} expanded notation: extension of file
-        if spec.endswith("f"):
-            ext = os.path.splitext(value)[1]
-            value = ext
-            spec = spec[:-1] + 's'
-        return super().format_field(value, spec)
+        transform, spec = self._split_spec(spec)
+        return self._format_value(value, transform, spec)
 
 
 class EscapedBraceExpansion(BraceExpansion):
@@ -122,29 +170,203 @@ class EscapedBraceExpansion(BraceExpansion):
         super().__init__(template)
 
     # This captures all brace expansion {} and {fn}
-    def format_field(self, value, spec):
-        value = super().format_field(value, spec)
+    # A list of filenames expands to each of them quoted, separated by spaces
+    def _format_value(self, value, transform, spec):
+        if isinstance(value, (list, tuple)):
+            return ' '.join(self._format_value(item, transform, spec) for item in value)
+        value = super()._format_value(value, transform, spec)
         shell_escape_value = shlex.quote(value)
         return shell_escape_value
 
 
 def invoke_shell(*args, command, labeled_filters=None, **kwargs) -> bytes:
-    # If any extra named arguments provided, use labeled_filters to carry it
-    if labeled_filters is not None:
-        kwargs.update(labeled_filters)
+    command_string = render_shell(*args, command=command, labeled_filters=labeled_filters, **kwargs)
     try:
-        output = subprocess.check_output(command(*args, **kwargs), shell=True)
+        stats.count('subprocess')
+        output = subprocess.check_output(command_string, shell=True)
     except subprocess.CalledProcessError as e:
-        msg = 'Command: "{cmd}" generated a code [{code}]\n' \
-              'Output: {output}'
-        log.error(msg.format(cmd=sanitize_object(e.cmd),
-                             code=e.returncode,
-                             output=sanitize_object(e.output)))
-        exit(1)
+        shell_error(e)
+    return output
+
+
+def render_shell(*args, command, labeled_filters=None, **kwargs) -> str:
+    # If any extra named arguments provided, use labeled_filters to carry it.
+    # Its values are only looked up when the command uses them
+    if labeled_filters is not None:
+        kwargs = ChainMap(kwargs, labeled_filters)
+    try:
+        return command.render(args, kwargs)
     except KeyError as e:
         log.error("Filter {}, not found".format(e))
         exit(1)
-    return output
+
+
+def shell_error(e: subprocess.CalledProcessError):
+    msg = 'Command: "{cmd}" generated a code [{code}]\n' \
+          'Output: {output}'
+    log.error(msg.format(cmd=sanitize_object(e.cmd),
+                         code=e.returncode,
+                         output=sanitize_object(e.output)))
+    exit(1)
+
+
+# Runs shell commands on an asyncio event loop in a background thread,
+# at most jobs of them at once. submit returns a concurrent.futures.Future.
+# A command running longer than timeout seconds is killed, and memory_limit (MB)
+# and cpu_limit (seconds of CPU time) are applied to each command where supported
+class AsyncShellPool:
+    def __init__(self, jobs, *, timeout=None, memory_limit=None, cpu_limit=None):
+        self.jobs = jobs
+        self.timeout = timeout
+        self.memory_limit = memory_limit
+        self.cpu_limit = cpu_limit
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+        # Created on the loop, older Pythons bind a semaphore to the running loop
+        self._semaphore = self._call(self._create_semaphore()).result()
+        # Commands run in their own session, out of reach of the terminal's Ctrl-C,
+        # so those still running are killed on exit
+        self._processes = set()
+        atexit.register(self.close)
+
+    def _call(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop)
+
+    async def _create_semaphore(self):
+        return asyncio.Semaphore(self.jobs)
+
+    # Prefixes the command with ulimit, the shell applies the limits to itself and its children
+    def _with_limits(self, command_string) -> str:
+        limits = list()
+        if self.memory_limit is not None:
+            limits.append("ulimit -v {}".format(math.ceil(self.memory_limit * 1024)))
+        if self.cpu_limit is not None:
+            limits.append("ulimit -t {}".format(math.ceil(self.cpu_limit)))
+        if os.name != 'posix' or not limits:
+            return command_string
+        return "".join("{} || exit 1\n".format(limit) for limit in limits) + command_string
+
+    # The command is started in its own process group, so a timeout kills
+    # the shell and every process it started, closing their output pipe
+    @staticmethod
+    def _kill(process):
+        if os.name == 'posix':
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+        else:
+            process.kill()
+
+    async def _run(self, command_string):
+        async with self._semaphore:
+            stats.count('subprocess')
+            process = await asyncio.create_subprocess_shell(self._with_limits(command_string),
+                                                            stdout=subprocess.PIPE,
+                                                            start_new_session=True)
+            self._processes.add(process)
+            try:
+                output, _ = await asyncio.wait_for(process.communicate(), self.timeout)
+            except asyncio.TimeoutError:
+                self._kill(process)
+                await process.wait()
+                raise subprocess.TimeoutExpired(command_string, self.timeout)
+            finally:
+                self._processes.discard(process)
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, command_string, output)
+        return output
+
+    def submit(self, command_string):
+        return self._call(self._run(command_string))
+
+    def close(self):
+        for process in list(self._processes):
+            self._kill(process)
+
+    # A process killed by a signal has a negative return code,
+    # the shell reports a command it started being killed as 128 + the signal
+    @staticmethod
+    def _killed(returncode):
+        return returncode < 0 or returncode > 128
+
+    # Waits for a submitted command, handling a failure like invoke_shell.
+    # A command which timed out or was killed (e.g. by --shell-cpu) gives no output
+    @classmethod
+    def result(cls, future) -> bytes:
+        try:
+            return future.result()
+        except subprocess.CalledProcessError as e:
+            if not cls._killed(e.returncode):
+                shell_error(e)
+            log.warning('Command: "{cmd}" was killed with code [{code}]'.format(
+                cmd=sanitize_object(e.cmd),
+                code=e.returncode))
+            return b''
+        except subprocess.TimeoutExpired as e:
+            log.warning('Command: "{cmd}" timed out after {timeout} seconds'.format(
+                cmd=sanitize_object(e.cmd),
+                timeout=e.timeout))
+            return b''
+
+
+# Runs command once for a list of filenames, in the style of xargs, splitting its
+# output back into one line per filename. If the number of lines doesn't match,
+# (e.g. a file produced no output) each filename is run on its own instead
+def invoke_shell_batch(filenames, *, command) -> list:
+    output = invoke_shell(list(filenames), command=command)
+    lines = output.splitlines()
+    if len(lines) == len(filenames):
+        return lines
+    log.debug("Command gave {lines} lines for {files} files, running each file separately".format(
+        lines=len(lines),
+        files=len(filenames)))
+    return [invoke_shell(filename, command=command) for filename in filenames]
+
+
+# A shell command started once and kept running. Each filename is written
+# to its standard input on its own line, and it must answer with one line of output
+# (flushed, e.g. "while read f; do du -b \"$f\" | cut -f1; done")
+class ShellCoprocess:
+    def __init__(self, command):
+        self.command = command
+        self._process = None
+        self._lock = threading.Lock()
+
+    def __call__(self, filename) -> bytes:
+        encoded_filename = os.fsencode(filename)
+        if b'\n' in encoded_filename:
+            log.warning("{} contains a newline, skipping".format(sanitize_object(filename)))
+            return b''
+
+        with self._lock:
+            if self._process is None:
+                stats.count('subprocess')
+                self._process = subprocess.Popen(self.command, shell=True,
+                                                 stdin=subprocess.PIPE,
+                                                 stdout=subprocess.PIPE)
+                atexit.register(self.close)
+            try:
+                self._process.stdin.write(encoded_filename + b'\n')
+                self._process.stdin.flush()
+                output = self._process.stdout.readline()
+            except BrokenPipeError:
+                output = b''
+
+        if not output:
+            msg = 'Command: "{cmd}" exited with code [{code}]'
+            log.error(msg.format(cmd=sanitize_object(self.command),
+                                 code=self._process.poll()))
+            exit(1)
+        return output
+
+    def close(self):
+        with self._lock:
+            if self._process is not None:
+                self._process.stdin.close()
+                self._process.wait()
+                self._process = None
 
 
 def sanitize_object(obj):
@@ -0,0 +1,90 @@
+import datetime
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'src'))
+
+from util import BatchKeys
+from util.BatchKeys import date_keys, date_label, size_keys
+
+# Zones with daylight saving, a half hour shift (Lord Howe), a quarter hour
+# offset (Kathmandu) and local mean time before 1900 (Amsterdam)
+zones = ('UTC', 'America/New_York', 'Europe/London', 'Australia/Lord_Howe',
+         'Asia/Kathmandu', 'Europe/Amsterdam')
+
+fields = ('MICROSECOND', 'SECOND', 'MINUTE', 'HOUR', 'DAY', 'MONTH', 'YEAR', 'WEEKDAY')
+
+
+# Timestamps every 7 minutes around the daylight saving changes of 2021
+# in New York, London and Lord Howe,
+# with fractions rounding either way, and a few before 1900
+def sample_timestamps():
+    timestamps = list()
+    for start in (1615705200, 1636264800, 1616893200, 1635642000, 1617462000, 1633188600):
+        timestamps.extend(start + minutes * 420 + 0.4999995 for minutes in range(-30, 30))
+        timestamps.extend(start + minutes * 420 + 0.9999996 for minutes in range(-30, 30))
+    timestamps.extend((-2500000000.25, -2208988800.0, 0.0, 1e9 + 0.5, 1700000000.123456))
+    return timestamps
+
+
+def expected_key(timestamp, field):
+    local = datetime.datetime.fromtimestamp(timestamp)
+    if field == 'WEEKDAY':
+        return local.weekday()
+    return getattr(local, field.lower())
+
+
+class TestDateKeys(unittest.TestCase):
+    def setUp(self):
+        self.timezone = os.environ.get('TZ')
+
+    def tearDown(self):
+        if self.timezone is None:
+            os.environ.pop('TZ', None)
+        else:
+            os.environ['TZ'] = self.timezone
+        time.tzset()
+        BatchKeys._local_blocks.clear()
+
+    def set_zone(self, zone):
+        os.environ['TZ'] = zone
+        time.tzset()
+        BatchKeys._local_blocks.clear()
+
+    def check_keys(self, batch_size):
+        timestamps = sample_timestamps()
+        for zone in zones:
+            self.set_zone(zone)
+            for field in fields:
+                for start in range(0, len(timestamps), batch_size):
+                    batch = timestamps[start:start + batch_size]
+                    with self.subTest(zone=zone, field=field, start=start):
+                        self.assertEqual(date_keys(batch, field),
+                                         [expected_key(timestamp, field) for timestamp in batch])
+
+    def test_python(self):
+        self.check_keys(BatchKeys._numpy_batch - 1)
+
+    def test_numpy(self):
+        if BatchKeys._load_numpy(BatchKeys._numpy_batch) is None:
+            self.skipTest("numpy is not installed")
+        self.check_keys(BatchKeys._numpy_batch * 4)
+
+    def test_labels(self):
+        self.assertEqual(date_label(6, 'WEEKDAY'), 'Sunday')
+        self.assertEqual(date_label(5, 'MONTH'), '05')
+        self.assertEqual(date_label(42, 'MICROSECOND'), '000042')
+        self.assertEqual(date_label(2021, 'YEAR'), '2021')
+
+
+class TestSizeKeys(unittest.TestCase):
+    def test_rounding(self):
+        sizes = [0, 511, 512, 513, 1535, 1536, 2560, 10 ** 12]
+        self.assertEqual(size_keys(sizes), sizes)
+        self.assertEqual(size_keys(sizes, 1024), [int(round(size / 1024, 0)) for size in sizes])
+
+
+if __name__ == '__main__':
+    unittest.main()